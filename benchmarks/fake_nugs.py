@@ -0,0 +1,234 @@
+import json
+import random
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+class FakeNugsCatalog:
+    """
+    Deterministic fake nugs catalog: artist i has albums_per_artist albums with tracks_per_album songs each
+    """
+    def __init__(self, artists: int = 50, albums_per_artist: int = 40, tracks_per_album: int = 20):
+        self.artists = artists
+        self.albums_per_artist = albums_per_artist
+        self.tracks_per_album = tracks_per_album
+
+    @staticmethod
+    def artist_name(artist_id: int) -> str:
+        return f'Fake Artist {artist_id}'
+
+    def album_ids(self, artist_id: int) -> list:
+        # newest first, like catalog.containersAll
+        return [artist_id * 100000 + j for j in range(self.albums_per_artist, 0, -1)]
+
+    def album(self, album_id: int) -> dict:
+        artist_id, number = divmod(album_id, 100000)
+        release_date = datetime(2000, 1, 1) + timedelta(days=number * 7)
+        return {
+            'containerID': album_id,
+            'containerInfo': f'{release_date:%m/%d/%Y} Fake Venue {number}',
+            'containerType': 1,
+            'artistName': self.artist_name(artist_id),
+            'artistID': artist_id,
+            'releaseDateFormatted': f'{release_date:%Y/%m/%d}',
+            'performanceDate': f'{release_date:%m/%d/%Y}',
+            'licensorName': 'Fake Licensor',
+            'img': {'url': f'/images/{album_id}.jpg'},
+            'songs': [{
+                'songID': album_id * 100 + k,
+                'trackID': album_id * 100 + k,
+                'songTitle': f'Fake Song {k}',
+                'trackNum': k,
+                'discNum': 1,
+            } for k in range(1, self.tracks_per_album + 1)]
+        }
+
+    @staticmethod
+    def stream_format(track_id: int, platform_id: str or None) -> str:
+        # every platformID returns a different format, which is stable per artist like the real API
+        formats = ['.alac16/', '.flac16/', '.mqa24/', '.aac150/']
+        offset = {'9': 0, '5': 1, '2': 2, None: 3}[platform_id]
+        artist_id = track_id // 100 // 100000
+        return formats[(artist_id + offset) % len(formats)]
+
+
+class FakeNugsHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, data: dict, status: int = 200, headers: dict = None):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _response(self, response: dict):
+        self._send_json({'Response': response, 'responseAvailabilityCode': 0, 'responseAvailabilityCodeStr': 'OK'})
+
+    def _simulate(self) -> bool:
+        # latency and errors of the real service, returns False if an error was sent
+        server = self.server
+        time.sleep(max(random.gauss(server.latency, server.latency / 4), 0))
+
+        if random.random() < server.error_rate:
+            if random.random() < 0.5:
+                self._send_json({'error': 'rate limited'}, status=429, headers={'Retry-After': '0'})
+            else:
+                self._send_json({'error': 'unavailable'}, status=503)
+            return False
+        return True
+
+    def do_POST(self):
+        self.server.count(self.path)
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+
+        if not self._simulate():
+            return
+
+        if urlparse(self.path).path == '/connect/token':
+            return self._send_json({'access_token': self.server.access_token, 'refresh_token': 'fake',
+                                    'expires_in': 3600})
+        self._send_json({}, status=404)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        self.server.count(url.path if url.path != '/api.aspx' else f"/api.aspx?method={params.get('method')}")
+
+        if url.path.startswith('/stream/'):
+            return self._stream()
+        if not self._simulate():
+            return
+
+        catalog = self.server.catalog
+        if url.path == '/connect/userinfo':
+            return self._send_json({'sub': '1'})
+        if url.path == '/api/v1/me/subscriptions/':
+            start = datetime.now() - timedelta(days=1)
+            return self._send_json({
+                'legacySubscriptionId': '1',
+                'plan': {'id': '1'},
+                'startedAt': f'{start:%m/%d/%Y %H:%M:%S}',
+                'endsAt': f'{start + timedelta(days=30):%m/%d/%Y %H:%M:%S}',
+            })
+        if url.path == '/bigriver/subPlayer.aspx':
+            track_id = int(params['trackID'])
+            stream_format = catalog.stream_format(track_id, params.get('platformID'))
+            return self._send_json({'streamLink': f'{self.server.base_url}/stream/{track_id}{stream_format}file'})
+        if url.path == '/secureApi.aspx' and params.get('method') == 'user.playlist':
+            return self._playlist(int(params['playlistID']))
+        if url.path == '/api.aspx':
+            method = params.get('method')
+            if method == 'catalog.container':
+                return self._response(catalog.album(int(params['containerID'])))
+            if method == 'catalog.artist.years':
+                return self._response({'ownerName': catalog.artist_name(int(params['artistId']))})
+            if method == 'catalog.containersAll':
+                return self._artist_albums(int(params['artistList']), int(params['startOffset']),
+                                           int(params['limit']))
+            if method == 'catalog.artists':
+                return self._response({'artists': [
+                    {'artistID': i, 'artistName': catalog.artist_name(i), 'numAlbums': catalog.albums_per_artist}
+                    for i in range(1, catalog.artists + 1)]})
+            if method == 'catalog.search':
+                return self._search(params.get('searchStr', ''))
+
+        self._send_json({}, status=404)
+
+    def _artist_albums(self, artist_id: int, page: int, limit: int):
+        album_ids = self.server.catalog.album_ids(artist_id)
+        self._response({
+            'containers': [self.server.catalog.album(a) for a in album_ids[(page - 1) * limit:page * limit]],
+            'totalMatchedRecords': len(album_ids),
+        })
+
+    def _playlist(self, playlist_id: int):
+        # a playlist takes the first two tracks of ten albums of an artist
+        catalog = self.server.catalog
+        artist_id = playlist_id % catalog.artists + 1
+        items = []
+        for album_id in catalog.album_ids(artist_id)[:10]:
+            album = catalog.album(album_id)
+            items += [{'track': song, 'playlistContainer': {'containerID': album_id}} for song in album['songs'][:2]]
+        self._response({'playListName': f'Fake Playlist {playlist_id}', 'userID': '1',
+                        'createDate': '2022-01-01', 'items': items})
+
+    def _search(self, query: str):
+        catalog = self.server.catalog
+        artist_ids = [i for i in range(1, catalog.artists + 1) if query.lower() in catalog.artist_name(i).lower()][:5]
+        albums = [catalog.album(a) for i in artist_ids for a in catalog.album_ids(i)[:2]]
+        self._response({'catalogSearchTypeContainers': [
+            {'matchType': 1, 'catalogSearchContainers': [{'matchedStr': catalog.artist_name(i)} for i in artist_ids]},
+            {'matchType': 6, 'catalogSearchContainers': [{'catalogSearchResultItems': [{
+                'containerID': a['containerID'], 'artistName': a['artistName'], 'containerName': a['containerInfo']}
+                for a in albums]}]},
+            {'matchType': 2, 'catalogSearchContainers': [{'catalogSearchResultItems': [{
+                'songID': s['songID'], 'trackID': s['trackID'], 'songTitle': s['songTitle'],
+                'containerID': a['containerID'], 'artistName': a['artistName'], 'containerName': a['containerInfo']}
+                for a in albums for s in a['songs'][:1]]}]},
+        ]})
+
+    def _stream(self):
+        # a small fake FLAC file: fLaC, a STREAMINFO block and some "audio frames", supports Range requests
+        body = b'fLaC' + bytes([0x80]) + (34).to_bytes(3, 'big') + bytes(34) + bytes(256 * 1024)
+        start, end = 0, len(body) - 1
+
+        range_header = self.headers.get('Range')
+        if range_header and range_header.startswith('bytes='):
+            first, _, last = range_header[len('bytes='):].partition('-')
+            start, end = int(first), min(int(last) if last else end, end)
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(body)}')
+        else:
+            self.send_response(200)
+
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Type', 'audio/flac')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        self.wfile.write(body[start:end + 1])
+
+
+class FakeNugsServer(ThreadingHTTPServer):
+    """
+    Local stand-in for streamapi.nugs.net, id.nugs.net, subscriptions.nugs.net and the CDN, all on one port
+    """
+    daemon_threads = True
+
+    def __init__(self, catalog: FakeNugsCatalog, latency: float = 0.05, error_rate: float = 0.0, port: int = 0):
+        super().__init__(('127.0.0.1', port), FakeNugsHandler)
+        self.catalog = catalog
+        self.latency = latency
+        self.error_rate = error_rate
+
+        self.base_url = f'http://127.0.0.1:{self.server_address[1]}'
+        # unsigned fake JWT with a legacy_token, NugsSession.get_legacy_token() only decodes the payload
+        self.access_token = 'e30.eyJsZWdhY3lfdG9rZW4iOiAiZmFrZSJ9.fake'
+
+        self.requests = Counter()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def count(self, path: str):
+        with self.lock:
+            self.requests[path] += 1
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name='fake-nugs', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,180 @@
+"""
+Offline benchmark of the nugs module against a local stand-in of the nugs API (see fake_nugs.py). Run it from the
+orpheusdl directory, so utils can be imported:
+
+    python -m modules.nugs.benchmarks.run --latency 0.05 --error-rate 0.01 --json bench.json
+"""
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from utils.models import CodecOptions, DownloadTypeEnum, QualityEnum
+
+from ..interface import ModuleInterface
+from ..nugs_api import NugsApi, NugsSession
+from ..nugs_metrics import metrics
+from .fake_nugs import FakeNugsCatalog, FakeNugsServer
+
+
+class TemporarySettings:
+    def __init__(self, settings: dict):
+        self.settings = settings
+
+    def read(self, key: str):
+        return self.settings.get(key)
+
+    def set(self, key: str, value):
+        self.settings[key] = value
+
+
+def create_module(server: FakeNugsServer, max_connections: int, prefetch_tracks: int) -> ModuleInterface:
+    # point every nugs host to the local server
+    NugsApi.API_URL = f'{server.base_url}/'
+    NugsSession.NUGS_AUTH_BASE = server.base_url
+    NugsSession.SUBSCRIPTIONS_URL = f'{server.base_url}/api/v1/me/subscriptions/'
+
+    module_controller = SimpleNamespace(
+        orpheus_options=SimpleNamespace(default_cover_options=SimpleNamespace(resolution=1400)),
+        module_error=Exception,
+        printer_controller=SimpleNamespace(oprint=lambda *args, **kwargs: None),
+        temporary_settings_controller=TemporarySettings({
+            'access_token': server.access_token,
+            'refresh_token': 'fake',
+            'expires': datetime.now() + timedelta(days=1),
+            'user_id': '1',
+            'username': 'benchmark@example.com'
+        }),
+        module_settings={'username': '', 'password': '', 'client_id': 'fake', 'dev_key': 'fake',
+                         'max_connections': max_connections, 'metrics_file': '', 'prefetch_tracks': prefetch_tracks,
+                         'incremental_artists': False, 'download_segments': 0,
+                         'cover_cache_size': 0, 'catalog_mirror': False}
+    )
+    return ModuleInterface(module_controller)
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(int(round(p / 100 * (len(values) - 1))), len(values) - 1)]
+
+
+class Benchmark:
+    def __init__(self, server: FakeNugsServer):
+        self.server = server
+        self.results = {}
+
+    def measure(self, name: str, function, *args, tracks: int = 0, **kwargs):
+        requests_before = sum(self.server.requests.values())
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+
+        stats = self.results.setdefault(name, {'latencies': [], 'requests': 0, 'tracks': 0})
+        stats['latencies'].append(elapsed)
+        stats['requests'] += sum(self.server.requests.values()) - requests_before
+        stats['tracks'] += tracks
+        return result
+
+    def report(self) -> dict:
+        report = {}
+        for name, stats in self.results.items():
+            latencies = stats['latencies']
+            report[name] = {
+                'calls': len(latencies),
+                'requests': stats['requests'],
+                'requests_per_track': round(stats['requests'] / stats['tracks'], 2) if stats['tracks'] else None,
+                'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+                'p95_ms': round(percentile(latencies, 95) * 1000, 1),
+                'throughput_per_s': round(len(latencies) / sum(latencies), 2) if sum(latencies) else None,
+            }
+        # ru_maxrss is in KiB on Linux
+        report['peak_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+        report['server_requests'] = dict(self.server.requests)
+        report['counters'] = metrics.to_dict()['counters']
+        return report
+
+
+def run(args) -> dict:
+    catalog = FakeNugsCatalog(args.artists, args.albums, args.tracks)
+    server = FakeNugsServer(catalog, latency=args.latency, error_rate=args.error_rate).start()
+
+    # the module keeps its caches in config/, so start with empty caches unless --cache-dir is given
+    os.chdir(args.cache_dir or tempfile.mkdtemp(prefix='nugs-bench-'))
+
+    benchmark = Benchmark(server)
+    module = benchmark.measure('startup', create_module, server, args.max_connections, args.prefetch_tracks)
+
+    quality_tier = QualityEnum[args.quality.upper()]
+    codec_options = CodecOptions(proprietary_codecs=False, spatial_codecs=False)
+    artist_ids = range(1, min(args.sample, catalog.artists) + 1)
+
+    for artist_id in artist_ids:
+        for query_type in (DownloadTypeEnum.artist, DownloadTypeEnum.album, DownloadTypeEnum.track):
+            benchmark.measure(f'search_{query_type.name}', module.search, query_type,
+                              catalog.artist_name(artist_id))
+
+    for artist_id in artist_ids:
+        artist_info = benchmark.measure('get_artist_info', module.get_artist_info, str(artist_id), False)
+
+        # Orpheus resolves one album after another and every track of it after another
+        album_id = artist_info.albums[0]
+        album_info = benchmark.measure('get_album_info', module.get_album_info, album_id,
+                                       **artist_info.album_extra_kwargs)
+        for track_id in album_info.tracks:
+            benchmark.measure('get_track_info', module.get_track_info, track_id, quality_tier, codec_options,
+                              tracks=1, **album_info.track_extra_kwargs)
+
+        playlist_info = benchmark.measure('get_playlist_info', module.get_playlist_info, str(artist_id))
+        for track_id in playlist_info.tracks:
+            benchmark.measure('get_track_info_playlist', module.get_track_info, track_id, quality_tier,
+                              codec_options, tracks=1, **playlist_info.track_extra_kwargs)
+
+    report = benchmark.report()
+    server.stop()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark of the nugs module')
+    parser.add_argument('--latency', type=float, default=0.05, help='mean latency of every request in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered with 429/503')
+    parser.add_argument('--artists', type=int, default=50, help='number of artists in the fake catalog')
+    parser.add_argument('--albums', type=int, default=40, help='number of albums per artist')
+    parser.add_argument('--tracks', type=int, default=20, help='number of tracks per album')
+    parser.add_argument('--sample', type=int, default=3, help='number of artists to run the scenarios for')
+    parser.add_argument('--quality', default='lossless', help='QualityEnum name used for get_track_info')
+    parser.add_argument('--max-connections', type=int, default=16)
+    parser.add_argument('--prefetch-tracks', type=int, default=4)
+    parser.add_argument('--cache-dir', help='reuse the caches of this directory (warm run)')
+    parser.add_argument('--json', help='also write the report to this file')
+    args = parser.parse_args()
+
+    # run() changes the working directory to the cache directory
+    args.json = os.path.abspath(args.json) if args.json else None
+    args.cache_dir = os.path.abspath(args.cache_dir) if args.cache_dir else None
+
+    report = run(args)
+
+    print(f"{'operation':<26}{'calls':>7}{'requests':>10}{'req/track':>11}{'p50 ms':>10}{'p95 ms':>10}{'ops/s':>9}")
+    for name, stats in report.items():
+        if isinstance(stats, dict) and 'calls' in stats:
+            print(f"{name:<26}{stats['calls']:>7}{stats['requests']:>10}{str(stats['requests_per_track'] or '-'):>11}"
+                  f"{stats['p50_ms']:>10}{stats['p95_ms']:>10}{str(stats['throughput_per_s'] or '-'):>9}")
+    print(f"peak RSS: {report['peak_rss_mb']} MB")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=4)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
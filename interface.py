@@ -1,19 +1,38 @@
+import atexit
+import io
 import logging
+import os
+import random
 import re
-from datetime import datetime
+import threading
+import time
+from contextvars import copy_context
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import asdict
+
+import requests
 
 from .mqa_identifier_python.mqa_identifier_python.mqa_identifier import MqaIdentifier
-from .nugs_api import NugsMobileSession, NugsApi
-from utils.utils import create_temp_filename, create_requests_session
+from .nugs_api import NugsMobileSession, NugsApi, NugsAlbum, NugsTrack, NugsLruCache, NugsSubscription, \
+    NugsNotAvailableError, create_nugs_session
+from .nugs_cache import NugsCache, NugsArtistIndex
+from .nugs_catalog import NugsCatalogMirror
+from .nugs_covers import NugsCoverCache
+from .nugs_download import NugsSegmentedDownloader
+from .nugs_formats import NugsStreamFormats, NugsPlatformStats
+from .nugs_metrics import metrics
 from utils.models import *
+from utils.utils import create_temp_filename
 
 
 module_information = ModuleInformation(
     service_name='nugs',
     module_supported_modes=ModuleModes.download | ModuleModes.covers,
     session_settings={'username': '', 'password': '', 'client_id': 'Eg7HuH873H65r5rt325UytR5429',
-                      'dev_key': 'x7f54tgbdyc64y656thy47er4'},
-    session_storage_variables=['access_token', 'refresh_token', 'expires', 'user_id', 'username'],
+                      'dev_key': 'x7f54tgbdyc64y656thy47er4', 'max_connections': 16, 'metrics_file': '',
+                      'prefetch_tracks': 4, 'incremental_artists': False, 'download_segments': 0,
+                      'cover_cache_size': 0, 'catalog_mirror': False},
+    session_storage_variables=['access_token', 'refresh_token', 'expires', 'user_id', 'username', 'subscription'],
     netlocation_constant='nugs',
     url_decoding=ManualEnum.manual,
     test_url='https://play.nugs.net/#/catalog/recording/28751'
@@ -46,8 +65,70 @@ class ModuleInterface:
             ".aac150/": {'codec': CodecEnum.AAC, 'bitrate': 150, 'priority': 0},
         }
 
+        # precomputed format classification and selection table
+        self.stream_formats = NugsStreamFormats(self.quality_parse, self.format_parse)
+
+        # the platformIDs which are probed for every track, every one of them returns a different format
+        self.stream_platforms = [9, 5, 2, None]
+        # deadline in seconds for all stream probes of a single track
+        self.stream_timeout = 30
+        # stop probing as soon as a stream with the highest wanted priority was found
+        self.stream_early_exit = True
+        # all probes share the pooled NugsApi.s session, so keep the workers below the pool size
+        self.stream_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='nugs-stream')
+
+        # in-memory MQA results of this run, also coalesces concurrent MQA probes of the same track
+        self.mqa_probes = NugsLruCache('mqa_probes', max_entries=4096)
+
+        # persistent cache next to the temporary settings, the found stream formats are kept for a week
+        self.cache = NugsCache(os.path.join('config', 'nugs_cache.db'))
+        self.stream_cache_ttl = 7 * 24 * 60 * 60
+        # learned platformID -> format mapping per artist and licensor, orders the probes
+        self.platform_stats = NugsPlatformStats(self.cache, self.stream_platforms)
+
+        # one keep-alive session for all nugs hosts (auth, subscriptions, streamapi and the CDN)
+        self.s = create_nugs_session(pool_maxsize=module_controller.module_settings['max_connections'])
+
         self.session = NugsApi(NugsMobileSession(module_controller.module_settings['client_id'],
-                                                 module_controller.module_settings['dev_key']))
+                                                 module_controller.module_settings['dev_key'], s=self.s),
+                               cache=self.cache, on_token_refresh=lambda _: self.save_session())
+
+        # download the audio files with several connections, 0 or 1 lets Orpheus download the stream url
+        self.downloader = NugsSegmentedDownloader(self.s, segments=module_controller.module_settings[
+            'download_segments'])
+
+        # covers are downloaded once and served from disk, a size of 0 (MB) disables the cache
+        self.covers = None
+        if module_controller.module_settings['cover_cache_size']:
+            self.covers = NugsCoverCache(self.s, self.cache, os.path.join('config', 'nugs_covers'),
+                                         max_bytes=module_controller.module_settings['cover_cache_size'] * 1024 * 1024)
+
+        # dump all collected metrics (*.prom for Prometheus text, JSON otherwise) when Orpheus exits
+        if module_controller.module_settings['metrics_file']:
+            atexit.register(metrics.dump, module_controller.module_settings['metrics_file'])
+
+        # resolve the next tracks of the album/playlist in the background while the current one is downloading
+        self.prefetch_tracks = module_controller.module_settings['prefetch_tracks']
+        self.prefetch_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='nugs-prefetch')
+        # the stream links expire, so prefetched tracks older than this are resolved again
+        self.prefetch_ttl = 10 * 60
+        # {(track_id, quality_tier, spatial_codecs, proprietary_codecs): (future, submitted)}
+        self.prefetched = {}
+        self.prefetch_lock = threading.Lock()
+
+        # number of catalog.containersAll pages which are fetched at the same time
+        self.page_workers = 4
+        # get_artist_info only returns the albums which weren't returned by the last run
+        self.incremental_artists = module_controller.module_settings['incremental_artists']
+
+        # nugs don't return the artistID in the search, so keep all artists locally and refresh them once a day
+        self.artist_index = NugsArtistIndex(self.session, self.cache, ttl=24 * 60 * 60)
+
+        # optional local mirror of the catalog, answers searches and album/track lookups without the API
+        self.catalog = None
+        if module_controller.module_settings['catalog_mirror']:
+            self.catalog = NugsCatalogMirror(self.cache, self.session, self.artist_index,
+                                             album_ttl=self.session.album_ttl)
 
         session = {
             'access_token': self.temp_settings.read('access_token'),
@@ -59,16 +140,44 @@ class ModuleInterface:
 
         self.session.session.set_session(session)
 
-        if session['refresh_token'] is not None and datetime.now() > session['expires']:
-            # access token expired, get new refresh token
+        # the token is refreshed by NugsApi and the subscription is loaded on the first call which needs them, so
+        # searches and cover-only jobs start without any request
+        self._sub = None
+        self.sub_lock = threading.Lock()
+
+    @property
+    def sub(self) -> NugsSubscription:
+        if self._sub is None or time.time() >= self._sub.end_stamp:
+            with self.sub_lock:
+                if self._sub is None or time.time() >= self._sub.end_stamp:
+                    self._sub = self.load_subscription()
+        return self._sub
+
+    def load_subscription(self, force: bool = False) -> NugsSubscription:
+        # reuse the saved subscription until it ends
+        subscription = self.temp_settings.read('subscription')
+        if not force and subscription and time.time() < subscription.get('end_stamp'):
+            return NugsSubscription(**subscription)
+
+        if self.session.token_expiring():
+            # access token (almost) expired, get new refresh token
             self.refresh_token()
 
-        self.sub = self.session.session.get_subscription()
+        sub = self.session.session.get_subscription()
+        if sub is not None:
+            self.temp_settings.set('subscription', asdict(sub))
+        return sub
 
     def login(self, email: str, password: str):
         logging.debug(f'{module_information.service_name}: no session found, login')
         self.session.session.auth(email, password)
 
+        self.save_session()
+
+        # the saved subscription could belong to another account
+        self._sub = self.load_subscription(force=True)
+
+    def save_session(self):
         # save the new access_token, refresh_token and expires in the temporary settings
         self.temp_settings.set('access_token', self.session.session.access_token)
         self.temp_settings.set('refresh_token', self.session.session.refresh_token)
@@ -76,20 +185,11 @@ class ModuleInterface:
         self.temp_settings.set('user_id', self.session.session.user_id)
         self.temp_settings.set('username', self.session.session.username)
 
-        self.sub = self.session.session.get_subscription()
-
     def refresh_token(self):
         logging.debug(f'{module_information.service_name}: access_token expired, getting a new one')
 
-        # get a new access_token and refresh_token from the API
-        self.session.session.refresh()
-
-        # save the new access_token, refresh_token and expires in the temporary settings
-        self.temp_settings.set('access_token', self.session.session.access_token)
-        self.temp_settings.set('refresh_token', self.session.session.refresh_token)
-        self.temp_settings.set('expires', self.session.session.expires)
-        self.temp_settings.set('user_id', self.session.session.user_id)
-        self.temp_settings.set('username', self.session.session.username)
+        # get a new access_token and refresh_token from the API, NugsApi saves them with save_session()
+        self.session.refresh_token(force=True)
 
     @staticmethod
     def custom_url_parse(link: str):
@@ -109,21 +209,39 @@ class ModuleInterface:
         )
 
     def search(self, query_type: DownloadTypeEnum, query, track_info: TrackInfo = None, limit: int = 10):
+        # the same (cached) catalog.search response holds the results of all query types
         results = self.session.get_search(query)
+        # the mirror only adds its matches, it doesn't know if all albums of an artist are mirrored
+        if self.catalog:
+            results = self.catalog.search(query, results)
+
+        return self.parse_search_results(query_type, results)
+
+    def search_batch(self, queries: list, query_types: list = None, max_workers: int = 8) -> dict:
+        """
+        Searches a list of queries (e.g. a setlist or the shows of a CSV) concurrently and returns
+        {query: {query_type: [SearchResult]}}
+        """
+        if query_types is None:
+            query_types = [DownloadTypeEnum.artist, DownloadTypeEnum.album, DownloadTypeEnum.track]
 
+        results = self.session.get_searches(queries, max_workers=max_workers)
+        return {query: {query_type: self.parse_search_results(query_type, results[query])
+                        for query_type in query_types} for query in queries}
+
+    def parse_search_results(self, query_type: DownloadTypeEnum, results: dict) -> list:
         items = []
         if query_type == DownloadTypeEnum.artist:
-            # nugs don't return the artistID so you have to fetch ALLLLLLL freaking artists
-            all_artists_data = self.session.get_all_artists().get('artists')
+            # nugs don't return the artistID so the matched names are looked up in the local artist index
             artist_results = [r for r in results.get('catalogSearchTypeContainers') if r.get('matchType') == 1]
 
             if len(artist_results) == 0:
                 return items
 
             for artist_result in artist_results[0].get('catalogSearchContainers'):
-                artist_name = artist_result.get('matchedStr')
-                # then you search for the matched artist string in ALL artists....
-                artist_data = [a for a in all_artists_data if a.get('artistName') == artist_name][0]
+                artist_data = self.artist_index.lookup(artist_result.get('matchedStr'))
+                if artist_data is None:
+                    continue
 
                 # get additional info such as numAlbums
                 total_albums = artist_data.get('numAlbums')
@@ -155,46 +273,91 @@ class ModuleInterface:
 
             for track_result in track_results[0].get('catalogSearchContainers'):
                 for track_data in track_result.get('catalogSearchResultItems'):
-                    track_data['albumID'] = track_data.get('containerID')
                     items.append(SearchResult(
                         result_id=track_data.get('songID'),
                         artists=[track_data.get('artistName')],
                         name=f"High Hopes: {track_data.get('containerName')}",
                         # get_track_info required the album_id and the track_data
-                        extra_kwargs={'data': {track_data.get('songID'): track_data}}
+                        extra_kwargs={'data': {track_data.get('songID'): NugsTrack.from_dict(
+                            track_data, album_id=track_data.get('containerID'))}}
                     ))
         else:
             raise Exception('Query type is invalid')
 
         return items
 
+    def iter_artist_albums(self, artist_id: str, incremental: bool = False, on_page=None):
+        """
+        Streaming variant of get_artist_info, yields (album_id, album_extra_kwargs) while later pages are loading.
+        incremental only yields the albums which weren't seen by the last incremental run of this artist
+        """
+        # the processed containerIDs, the listed but not yet processed ones and the newest processed release date,
+        # the first run returns all albums
+        sync = self.cache.get_artist_sync(artist_id) if incremental else None
+        album_ids, pending_ids, newest_date = sync if sync else (set(), set(), None)
+
+        new_album_ids, albums = set(), []
+        for album in self.session.iter_artist_albums(artist_id, max_workers=self.page_workers,
+                                                     known_ids=album_ids | pending_ids if sync else None,
+                                                     newest_date=newest_date, pending_ids=pending_ids,
+                                                     on_page=on_page):
+            # only save the albums
+            if album.get('containerType') == 1:
+                new_album_ids.add(str(album.get('containerID')))
+                albums.append(NugsAlbum.from_dict(album))
+                yield album.get('containerID'), {'data': {album.get('containerID'): albums[-1]}}
+            else:
+                # the videos are never processed, so the next run can already stop at them
+                album_ids.add(str(album.get('containerID')))
+
+        if self.catalog:
+            self.catalog.add_albums(albums)
+
+        if incremental:
+            # the albums of earlier runs which weren't processed (e.g. a failed download) and weren't on the listed
+            # pages are fetched again, the ones which are gone or fail aren't pending anymore
+            missing_ids = sorted(pending_ids - new_album_ids, reverse=True)
+            with ThreadPoolExecutor(max_workers=self.page_workers, thread_name_prefix='nugs-pending') as executor:
+                for album_id, album in zip(missing_ids, executor.map(self._get_pending_album, missing_ids)):
+                    if album is None:
+                        pending_ids.discard(album_id)
+                        continue
+                    yield album_id, {'data': {album_id: album}}
+
+            # get_album_info confirms every album once it's processed, an aborted listing starts over the next time
+            self.cache.set_artist_sync(artist_id, album_ids, pending_ids | new_album_ids, newest_date)
+
+    def _get_pending_album(self, album_id: str) -> NugsAlbum or None:
+        try:
+            return self.get_album(album_id)
+        except (NugsNotAvailableError, ConnectionError, requests.RequestException) as e:
+            logging.debug(f'{module_information.service_name}: dropping pending album {album_id}: {e}')
+            return None
+
     def get_artist_info(self, artist_id: str, get_credited_albums: bool) -> ArtistInfo:
         artist_data = self.session.get_artist(artist_id)
-        artist_albums_data = self.session.get_artist_albums(artist_id)
 
         # now save all the albums
-        artist_albums = [a for a in artist_albums_data.get('containers') if a.get('containerType') == 1]
-        total_items = artist_albums_data.get('totalMatchedRecords')
-        for page in range(2, total_items // 100 + 2):
-            print(f'Fetching {page * 100}/{total_items}', end='\r')
-            artist_albums += [a for a in self.session.get_artist_albums(artist_id, offset=page).get('containers')
-                              if a.get('containerType') == 1]
+        albums, album_extra_kwargs = [], {'data': {}}
+        for album_id, extra_kwargs in self.iter_artist_albums(
+                artist_id, incremental=self.incremental_artists,
+                on_page=lambda listed, total: print(f'Fetching {listed}/{total}', end='\r')):
+            albums.append(album_id)
+            album_extra_kwargs['data'].update(extra_kwargs['data'])
 
         return ArtistInfo(
             name=artist_data.get('ownerName'),
-            albums=[a.get('containerID') for a in artist_albums],
-            album_extra_kwargs={'data': {a.get('containerID'): a for a in artist_albums}},
+            albums=albums,
+            album_extra_kwargs=album_extra_kwargs,
         )
 
     def get_playlist_info(self, playlist_id):
         playlist_data = self.session.get_user_playlist(playlist_id)
 
-        cache = {'data': {t.get('track').get('songID'): t.get('track') for t in playlist_data.get('items')}}
-        for track in playlist_data.get('items'):
-            # stupid API don't save the albumID in the track so every track has the album data attached in
-            # playlistContainer, so dumb
-            album_data = track.get('playlistContainer')
-            cache['data'][track.get('track').get('songID')]['albumID'] = album_data.get('containerID')
+        # stupid API don't save the albumID in the track so every track has the album data attached in
+        # playlistContainer, so dumb
+        cache = {'data': {t.get('track').get('songID'): NugsTrack.from_dict(
+            t.get('track'), album_id=t.get('playlistContainer').get('containerID')) for t in playlist_data.get('items')}}
 
         return PlaylistInfo(
             name=playlist_data.get('playListName'),
@@ -205,99 +368,297 @@ class ModuleInterface:
             track_extra_kwargs=cache
         )
 
+    def get_album(self, album_id: str) -> NugsAlbum:
+        # the mirror answers first, everything else is added to it
+        album_data = self.catalog.get_album(album_id) if self.catalog else None
+        if self.catalog:
+            metrics.count('cache_hits' if album_data else 'cache_misses', cache='catalog_mirror')
+
+        if album_data is None:
+            album_data = self.session.get_album(album_id)
+            if self.catalog:
+                self.catalog.add_albums([album_data])
+        return album_data
+
+    def sync_catalog(self, artist_ids: list = None):
+        """
+        Incremental refresh of the catalog mirror, by default of all mirrored artists
+        """
+        if not self.catalog:
+            raise self.exception('Set "catalog_mirror": true to use the catalog mirror')
+        self.catalog.refresh(artist_ids, max_workers=self.page_workers)
+
     def get_album_info(self, album_id: str, data=None) -> AlbumInfo:
         # check if album is already in album cache, add it
         if data is None:
             data = {}
 
-        album_data = data.get(album_id) if album_id in data else self.session.get_album(album_id)
+        # the artist's album cache isn't needed anymore once the album is resolved, so release it
+        album_data = data.pop(album_id, None) or self.get_album(album_id)
+
+        # the incremental artist sync only skips this album from now on
+        if self.incremental_artists and album_data.artist_id is not None:
+            self.cache.confirm_artist_album(album_data.artist_id, album_data.container_id,
+                                            album_data.release_date_formatted)
 
         # create the cache with all the tracks and the album data
         cache = {'data': {album_id: album_data}}
-        cache['data'].update({s.get('songID'): s for s in album_data.get('songs')})
-        for track in album_data.get('songs'):
-            cache['data'][track.get('songID')]['albumID'] = album_id
+        cache['data'].update({t.song_id: t for t in album_data.tracks})
 
         return AlbumInfo(
-            name=album_data.get('containerInfo'),
-            release_year=album_data.get('releaseDateFormatted')[:4] if album_data.get('releaseDateFormatted') else None,
-            cover_url=f"https://secure.livedownloads.com{album_data.get('img').get('url')}",
-            artist=album_data.get('artistName'),
-            artist_id=album_data.get('artistID'),
-            tracks=[t.get('songID') for t in album_data.get('songs')],
+            name=album_data.container_info,
+            release_year=album_data.release_date_formatted[:4] if album_data.release_date_formatted else None,
+            cover_url=self.cover_url(album_data.img_url),
+            artist=album_data.artist_name,
+            artist_id=album_data.artist_id,
+            tracks=[t.song_id for t in album_data.tracks],
             track_extra_kwargs=cache
         )
 
-    def parse_stream_format(self, stream_url: str):
-        # return the quality of the stream and None if it's not a file
-        for key, value in self.format_parse.items():
-            if key in stream_url:
-                return value
-        return None
+    def get_stream_data(self, track_id: str, wanted_quality: tuple = None, wanted_mask: int = None,
+                        album_data: NugsAlbum = None) -> list:
+        # wanted_quality are the wanted priorities with the highest first, wanted_mask their bit mask
+        plan_id = self.sub.sub_cost_plan_id_access_list
+        highest_priority = wanted_quality[0] if wanted_quality else None
+
+        # warm run: only fetch the stream of the best cached format
+        cached = self.cache.get_stream_formats(track_id, plan_id, self.stream_cache_ttl)
+        metrics.count('cache_hits' if cached else 'cache_misses', cache='stream_formats')
+        if cached and wanted_quality is not None:
+            formats, complete = cached
+            stream_data = sorted([dict(self.format_parse[k], format_key=k, platform_id=p)
+                                  for k, p in formats.items() if k in self.format_parse],
+                                 key=lambda k: k['priority'], reverse=True)
+            wanted_streams = [s for s in stream_data if s['priority'] in wanted_quality]
+
+            # an incomplete probe can only be trusted if it already found the best wanted format
+            if complete or (wanted_streams and wanted_streams[0]['priority'] == highest_priority):
+                if not wanted_streams:
+                    return stream_data
+
+                selected_stream = wanted_streams[0]
+                stream_url = self.session.get_stream(track_id, self.sub, selected_stream['platform_id']).get(
+                    'streamLink')
+                if self.stream_formats.classify(stream_url) == selected_stream['format_key']:
+                    selected_stream['stream_url'] = stream_url
+                    # keep the other unwanted formats for the spatial/proprietary warnings
+                    return [selected_stream] + [s for s in stream_data if s['priority'] not in wanted_quality]
+
+            # the platformID returned a different format, so the cache is outdated
+            self.cache.delete_stream_formats(track_id, plan_id)
+
+        # the API docs say it's random which format every platformID returns, but it's stable per artist and
+        # licensor, so probe the platformID which most likely returns the best wanted format first
+        scopes = self.platform_stats.scopes(album_data)
+        predicted = self.platform_stats.predict(scopes)
+        # sometimes probe every platformID, so predictions of platformIDs which are never requested get corrected
+        if predicted and random.random() < self.platform_stats.explore_rate:
+            predicted = {}
+
+        if wanted_mask is not None:
+            # platformIDs which only return unwanted formats are only requested if the prediction was wrong
+            queued, target_priority = self.stream_formats.probe_order(wanted_mask, self.stream_platforms, predicted)
+        else:
+            queued, target_priority = list(self.stream_platforms), None
+        skipped = [p for p in self.stream_platforms if p not in queued]
+        if target_priority is None:
+            target_priority = highest_priority
+
+        # the deadline starts when the first probe runs, the probes can be queued behind other tracks in the
+        # shared stream_executor (e.g. in get_tracks_info)
+        started = []
+
+        def probe(platform_id):
+            started.append(time.monotonic())
+            return self.session.get_stream(track_id, self.sub, platform_id)
+
+        futures = {}
+        pending = set()
+
+        stream_data = []
+        formats = {}
+        observed = {}
+        try:
+            while pending or queued:
+                if not pending:
+                    # a predicted winner is probed alone, everything else concurrently
+                    wave, queued = (queued[:1], queued[1:]) if queued[0] in predicted else (queued, [])
+                    # run the probes in a copy of the context, so they are recorded in the span of the track
+                    for platform_id in wave:
+                        future = self.stream_executor.submit(copy_context().run, probe, platform_id)
+                        futures[future] = platform_id
+                        pending.add(future)
+
+                deadline = (started[0] if started else time.monotonic()) + self.stream_timeout
+                done, pending = wait(pending, timeout=max(deadline - time.monotonic(), 0),
+                                     return_when=FIRST_COMPLETED)
+                if not done:
+                    # still queued, nothing was requested yet
+                    if not started:
+                        continue
+                    logging.debug(f'{module_information.service_name}: stream probes for {track_id} timed out')
+                    break
+
+                for future in done:
+                    stream_url = future.result().get('streamLink')
+                    format_key = self.stream_formats.classify(stream_url)
+                    observed[futures[future]] = format_key or ''
+                    if format_key:
+                        stream = {'stream_url': stream_url, 'format_key': format_key}
+                        stream.update(self.format_parse[format_key])
+                        stream_data.append(stream)
+
+                        formats.setdefault(format_key, futures[future])
+
+                # early exit, nothing better than the target priority can be selected anyway
+                satisfied = target_priority is not None and any(
+                    s['priority'] >= target_priority and wanted_mask >> s['priority'] & 1 for s in stream_data)
+                if self.stream_early_exit and satisfied:
+                    break
+
+                # the probes returned less than predicted, so the skipped platformIDs could be predicted wrong too
+                if not pending and not queued and skipped and not satisfied:
+                    queued, skipped = skipped, []
+        finally:
+            # drop the probes that are still queued, running ones can't be stopped
+            for future in pending:
+                future.cancel()
+
+        if not stream_data and pending:
+            raise self.exception(f'Timed out while fetching the streams of track {track_id}')
+
+        self.platform_stats.record(scopes, observed)
+
+        # the cached formats are shared by all quality settings, so only a probe of every platformID is complete
+        self.cache.set_stream_formats(track_id, plan_id, formats,
+                                      complete=len(observed) == len(self.stream_platforms))
+
+        # sort the dict by priority
+        return sorted(stream_data, key=lambda k: k['priority'], reverse=True)
 
     def get_track_info(self, track_id: str, quality_tier: QualityEnum, codec_options: CodecOptions,
                        data=None) -> TrackInfo:
+        resolved = self.get_prefetched_track_info(track_id, quality_tier, codec_options)
+        if resolved is None:
+            resolved = self.resolve_track_info(track_id, quality_tier, codec_options, data)
+        track_info, warnings = resolved
+
+        # the warnings of prefetched tracks are printed now, not in the middle of the previous download
+        for warning in warnings:
+            self.print(warning, drop_level=1)
+
+        # Orpheus only asks for the next track after this one is downloaded, so resolve it in the meantime
+        self.prefetch_next_tracks(track_id, quality_tier, codec_options, data)
+        return track_info
+
+    def resolve_track_info(self, track_id: str, quality_tier: QualityEnum, codec_options: CodecOptions,
+                           data=None, prefetch: bool = False) -> tuple:
+        """
+        Returns (TrackInfo, warnings), the warnings have to be printed by the caller's thread
+        """
+        warnings = []
+        # all requests of this track are recorded in a span, so slow tracks can be traced to their requests
+        with metrics.span('get_track_info', track_id=track_id, prefetch=prefetch):
+            return self._get_track_info(track_id, quality_tier, codec_options, data, warnings), warnings
+
+    @staticmethod
+    def prefetch_key(track_id: str, quality_tier: QualityEnum, codec_options: CodecOptions) -> tuple:
+        return track_id, quality_tier, bool(codec_options.spatial_codecs), bool(codec_options.proprietary_codecs)
+
+    def get_prefetched_track_info(self, track_id: str, quality_tier: QualityEnum,
+                                  codec_options: CodecOptions) -> tuple or None:
+        with self.prefetch_lock:
+            prefetched = self.prefetched.pop(self.prefetch_key(track_id, quality_tier, codec_options), None)
+        metrics.count('cache_hits' if prefetched else 'cache_misses', cache='prefetch')
+        if prefetched is None:
+            return None
+
+        future, submitted = prefetched
+        try:
+            # waits for the prefetch if it's still running
+            resolved = future.result()
+        except Exception:
+            # resolve it again, so the error is raised in the right place
+            return None
+
+        # the stream link is too old, resolve it again
+        if time.monotonic() - submitted > self.prefetch_ttl:
+            return None
+        return resolved
+
+    def prefetch_next_tracks(self, track_id: str, quality_tier: QualityEnum, codec_options: CodecOptions, data=None):
+        if not self.prefetch_tracks or not data:
+            return
+
+        # the track_extra_kwargs of albums and playlists hold all tracks in order
+        track_ids = [k for k, v in data.items() if isinstance(v, NugsTrack)]
+        if track_id not in track_ids:
+            return
+        index = track_ids.index(track_id)
+
+        with self.prefetch_lock:
+            now = time.monotonic()
+            # drop the prefetches which were never used, e.g. of a skipped album
+            for key, (future, submitted) in list(self.prefetched.items()):
+                if now - submitted > self.prefetch_ttl:
+                    future.cancel()
+                    del self.prefetched[key]
+
+            for next_track_id in track_ids[index + 1:index + 1 + self.prefetch_tracks]:
+                key = self.prefetch_key(next_track_id, quality_tier, codec_options)
+                if key not in self.prefetched:
+                    # no copy of the context, the prefetch gets its own span
+                    self.prefetched[key] = (self.prefetch_executor.submit(
+                        self.resolve_track_info, next_track_id, quality_tier, codec_options, data, True), now)
+
+    def _get_track_info(self, track_id: str, quality_tier: QualityEnum, codec_options: CodecOptions,
+                        data=None, warnings: list = None) -> TrackInfo:
         if data is None:
             data = {}
+        if warnings is None:
+            warnings = []
 
         track_data = data[track_id] if track_id in data else None
+        # without the track_extra_kwargs the mirror still knows the album of the track
+        if track_data is None and self.catalog:
+            track_data, _ = self.catalog.get_track_album(track_id)
         # get the manually added albumID
-        album_id = track_data.get('albumID')
+        album_id = track_data.album_id
 
-        album_data = data[album_id] if album_id in data else self.session.get_album(album_id)
+        album_data = data[album_id] if album_id in data else self.get_album(album_id)
 
-        track_name = track_data.get('songTitle')
-        release_year = album_data.get('releaseDateFormatted')[:4] if album_data.get('releaseDateFormatted') else None
+        track_name = track_data.song_title
+        release_year = album_data.release_date_formatted[:4] if album_data.release_date_formatted else None
 
         tags = Tags(
-            album_artist=album_data.get('artistsID'),
-            track_number=track_data.get('trackNum'),
-            disc_number=track_data.get('discNum'),
-            total_tracks=len(album_data.get('songs')),
-            release_date=album_data.get('releaseDateFormatted').replace('/', '-') if album_data.get(
-                'releaseDateFormatted') else None,
-            copyright=f'© {release_year} {album_data.get("licensorName")}',
+            album_artist=album_data.artist_name,
+            track_number=track_data.track_num,
+            disc_number=track_data.disc_num,
+            total_tracks=len(album_data.tracks),
+            release_date=album_data.release_date_formatted.replace('/', '-') if album_data.release_date_formatted
+            else None,
+            copyright=f'© {release_year} {album_data.licensor_name}',
         )
 
-        error, selected_stream, quality, mqa_file = None, None, None, None
+        error, selected_stream = None, None
 
-        # why is the API so stupid? Those formats make absolutely no sense, and it's random what you get
-        stream_data = []
-        for stream_format in [9, 5, 2, None]:
-            stream_url = self.session.get_stream(track_data.get('trackID'), self.sub, stream_format).get('streamLink')
-            quality = self.parse_stream_format(stream_url)
-            if quality:
-                stream = {'stream_url': stream_url}
-                stream.update(quality)
-                stream_data.append(stream)
+        # get the wanted priorities (highest first) from the settings.json
+        wanted_quality, wanted_mask = self.stream_formats.wanted(quality_tier, codec_options)
 
-        # sort the dict by priority
-        stream_data = sorted(stream_data, key=lambda k: k['priority'], reverse=True)
+        stream_data = self.get_stream_data(track_data.track_id, wanted_quality, wanted_mask, album_data)
 
         # check if the track is spatial and if spatial_codecs is enabled
         if not codec_options.spatial_codecs and any([codec_data[s.get('codec')].spatial for s in stream_data]):
-            self.print(f'Spatial codecs are disabled, if you want to download Sony 360RA, '
-                       f'set "spatial_codecs": true', drop_level=1)
+            warnings.append(f'Spatial codecs are disabled, if you want to download Sony 360RA, '
+                            f'set "spatial_codecs": true')
 
         # check if the track is proprietary and if proprietary_codecs is enabled
         if not codec_options.proprietary_codecs and any([codec_data[s.get('codec')].proprietary for s in stream_data]):
-            self.print(f'Proprietary codecs are disabled, if you want to download MQA, '
-                       f'set "proprietary_codecs": true', drop_level=1)
-
-        # get the highest wanted quality from the settings.json
-        highest_priority = self.quality_parse[quality_tier]
-        # set the highest wanted priority to match Sony 360RA
-        if codec_options.spatial_codecs:
-            highest_priority = 4
-
-        wanted_quality = [i for i in range(highest_priority + 1)]
-
-        # remove the MQA priority
-        if not codec_options.proprietary_codecs:
-            wanted_quality.remove(3)
+            warnings.append(f'Proprietary codecs are disabled, if you want to download MQA, '
+                            f'set "proprietary_codecs": true')
 
         # filter out non-valid streams
-        valid_streams = [i for i in stream_data if i['priority'] in wanted_quality]
+        valid_streams = [i for i in stream_data if wanted_mask >> i['priority'] & 1]
 
         if len(valid_streams) > 0:
             # select the highest valid stream
@@ -310,11 +671,12 @@ class ModuleInterface:
             sample_rate = 48 if track_codec in {CodecEnum.MHA1} else 44.1
 
             if track_codec == CodecEnum.MQA:
-                # download the first chunk of the flac file to analyze it
-                temp_file_path = self.download_temp_header(selected_stream.get('stream_url'))
+                mqa_info = self.get_mqa_info(track_data.track_id, selected_stream.get('stream_url'))
 
-                # detect MQA file
-                mqa_file = MqaIdentifier(temp_file_path)
+                # now set everything for MQA
+                if mqa_info['is_mqa']:
+                    bit_depth = mqa_info['bit_depth']
+                    sample_rate = mqa_info['sample_rate']
 
         else:
             error = f'Selected quality is not available'
@@ -323,51 +685,206 @@ class ModuleInterface:
             bit_depth = None
             sample_rate = None
 
-        # now set everything for MQA
-        if mqa_file is not None and mqa_file.is_mqa:
-            bit_depth = mqa_file.bit_depth
-            sample_rate = mqa_file.get_original_sample_rate()
-
         track_info = TrackInfo(
             name=track_name,
-            album=album_data.get('containerInfo'),
-            album_id=album_data.get('containerID'),
-            artists=[album_data.get('artistName')],
-            artist_id=album_data.get('artistID'),
+            album=album_data.container_info,
+            album_id=album_data.container_id,
+            artists=[album_data.artist_name],
+            artist_id=album_data.artist_id,
             release_year=release_year,
-            cover_url=f"https://secure.livedownloads.com{album_data.get('img').get('url')}",
+            cover_url=self.cover_url(album_data.img_url),
             tags=tags,
             codec=track_codec,
             bitrate=bitrate,
             bit_depth=bit_depth,
             sample_rate=sample_rate,
-            download_extra_kwargs={'stream_url': selected_stream.get('stream_url')},
+            download_extra_kwargs={'stream_url': selected_stream.get('stream_url') if selected_stream else None},
             error=error
         )
 
         return track_info
 
+    def get_tracks_info(self, track_ids: list, quality_tier: QualityEnum, codec_options: CodecOptions,
+                        data=None, max_workers: int = 8) -> list:
+        """
+        Batch version of get_track_info for the track_extra_kwargs of get_album_info and get_playlist_info, returns
+        the TrackInfo objects in the order of track_ids
+        """
+        # don't add the albums to the caller's cache
+        data = dict(data) if data else {}
+
+        # look up every album only once before fanning out
+        album_ids = {data[t].album_id for t in track_ids if t in data}
+        for album_id in album_ids - data.keys():
+            data[album_id] = self.get_album(album_id)
+
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='nugs-tracks') as executor:
+            futures = {}
+            for track_id in track_ids:
+                # duplicated tracks are only resolved once
+                if track_id not in futures:
+                    futures[track_id] = executor.submit(copy_context().run, self.resolve_track_info, track_id,
+                                                        quality_tier, codec_options, data)
+            results = {track_id: future.result() for track_id, future in futures.items()}
+
+        # print the warnings in the caller's thread
+        for _, warnings in results.values():
+            for warning in warnings:
+                self.print(warning, drop_level=1)
+        return [results[track_id][0] for track_id in track_ids]
+
+    def get_mqa_info(self, track_id: str, stream_url: str) -> dict:
+        # the MQA analysis never changes for a track, so it's only done once, concurrent probes are coalesced
+        format_key = '.mqa24/'
+        return self.mqa_probes.get((str(track_id), format_key),
+                                   lambda: self._get_mqa_info(track_id, format_key, stream_url))
+
+    def _get_mqa_info(self, track_id: str, format_key: str, stream_url: str) -> dict:
+        mqa_info = self.cache.get_mqa(track_id, format_key)
+        metrics.count('cache_hits' if mqa_info else 'cache_misses', cache='mqa')
+        if mqa_info is not None:
+            return mqa_info
+
+        # download the first chunk of the flac file to analyze it
+        header = self.download_header(stream_url)
+        if header is None:
+            # the stream is gone, so the cached stream formats are outdated
+            self.cache.delete_stream_formats(track_id, self.sub.sub_cost_plan_id_access_list)
+            raise self.exception(f'Stream of track {track_id} is not available anymore, try again')
+
+        # detect MQA file
+        mqa_file = MqaIdentifier(io.BytesIO(header))
+        mqa_info = {
+            'is_mqa': mqa_file.is_mqa,
+            'bit_depth': mqa_file.bit_depth if mqa_file.is_mqa else None,
+            'sample_rate': mqa_file.get_original_sample_rate() if mqa_file.is_mqa else None
+        }
+
+        # a truncated or broken header would cache a wrong result forever
+        if self.flac_audio_offset(header) is not None:
+            self.cache.set_mqa(track_id, format_key, mqa_info)
+        return mqa_info
+
+    def prewarm_mqa_cache(self, media_id: str, media_type: DownloadTypeEnum = DownloadTypeEnum.album,
+                          max_workers: int = 8) -> int:
+        """
+        Analyzes all MQA tracks of an album or artist concurrently and returns the number of analyzed tracks
+        """
+        if media_type == DownloadTypeEnum.artist:
+            # the listing already holds the albums, so no catalog.container request is needed
+            albums = [extra_kwargs['data'][album_id] for album_id, extra_kwargs in self.iter_artist_albums(media_id)]
+        elif media_type == DownloadTypeEnum.album:
+            albums = [self.get_album(media_id)]
+        else:
+            raise self.exception('Media type is invalid')
+
+        # only probe until the MQA stream was found
+        wanted_quality, wanted_mask = self.stream_formats.wanted(
+            QualityEnum.HIFI, CodecOptions(proprietary_codecs=True, spatial_codecs=False))
+
+        def prewarm_track(track_id: str, album_data: NugsAlbum) -> bool:
+            mqa_streams = [s for s in self.get_stream_data(track_id, wanted_quality, wanted_mask, album_data)
+                           if s['codec'] == CodecEnum.MQA]
+            if mqa_streams:
+                self.get_mqa_info(track_id, mqa_streams[0]['stream_url'])
+            return bool(mqa_streams)
+
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='nugs-prewarm') as executor:
+            return sum(executor.map(lambda t: prewarm_track(*t), [(t.track_id, a) for a in albums for t in a.tracks]))
+
     @staticmethod
-    def download_temp_header(file_url: str, chunk_size: int = 32768) -> str:
-        # create flac temp_location
-        temp_location = create_temp_filename() + '.flac'
-
-        # create session and download the file to the temp_location
-        r_session = create_requests_session()
-
-        r = r_session.get(file_url, stream=True, verify=False)
-        with open(temp_location, 'wb') as f:
-            # only download the first chunk_size bytes
-            for chunk in r.iter_content(chunk_size=chunk_size):
-                if chunk:  # filter out keep-alive new chunks
-                    f.write(chunk)
+    def flac_audio_offset(header: bytes) -> int or None:
+        # returns the offset of the first audio frame after all FLAC metadata blocks (STREAMINFO, pictures, ...) or
+        # None if the header doesn't contain all metadata blocks yet
+        if header[:4] != b'fLaC':
+            return None
+
+        offset = 4
+        while offset + 4 <= len(header):
+            is_last = header[offset] & 0x80
+            offset += 4 + int.from_bytes(header[offset + 1:offset + 4], 'big')
+            if is_last:
+                return offset if offset <= len(header) else None
+        return None
+
+    def download_header(self, file_url: str, size: int = 32768, audio_size: int = 32768,
+                        max_size: int = 1024 * 1024) -> bytes or None:
+        # only download the first bytes of the flac file into memory, the range grows until the metadata blocks and
+        # audio_size bytes of audio frames are available
+        header = b''
+        while True:
+            r = self.s.get(file_url, headers={'Range': f'bytes={len(header)}-{size - 1}'}, stream=True, verify=False)
+            # everything else (401, 403, 404, 416, ...) is an error body and no flac file
+            if r.status_code not in {200, 206}:
+                r.close()
+                return None
+
+            # the server ignored the Range header and sends the whole file, so start from the beginning
+            if r.status_code == 200:
+                header = b''
+
+            chunks = [header]
+            received = len(header)
+            for chunk in r.iter_content(chunk_size=16384):
+                chunks.append(chunk)
+                received += len(chunk)
+                # don't stream the whole file if the server ignores the Range header
+                if received >= size:
                     break
+            r.close()
+
+            end_of_file = received < size
+            header = b''.join(chunks)[:size]
+
+            audio_offset = self.flac_audio_offset(header)
+            if end_of_file or (audio_offset is not None and len(header) - audio_offset >= audio_size):
+                return header
+            # the metadata blocks are bigger than max_size, so it's no usable header
+            if size >= max_size:
+                return header if audio_offset is not None else None
 
-        return temp_location
+            size = min(max(size * 2, (audio_offset or 0) + audio_size), max_size)
+
+    def cover_url(self, img_url: str) -> str:
+        cover_url = f'https://secure.livedownloads.com{img_url}'
+        return self.covers.local_url(cover_url) if self.covers else cover_url
+
+    def get_track_cover(self, track_id: str, cover_options: CoverOptions, data=None) -> CoverInfo:
+        if data is None:
+            data = {}
+
+        track_data = data[track_id] if track_id in data else None
+        album_id = track_data.album_id
+        album_data = data[album_id] if album_id in data else self.get_album(album_id)
+
+        # nugs only has one size, so the cover_options can't be applied
+        file_type = os.path.splitext(album_data.img_url or '')[1].lstrip('.').lower()
+        return CoverInfo(
+            url=self.cover_url(album_data.img_url),
+            file_type=ImageFileTypeEnum[file_type] if file_type in ImageFileTypeEnum.__members__
+            else ImageFileTypeEnum.jpg
+        )
 
     def get_track_download(self, stream_url: str) -> TrackDownloadInfo:
+        headers = {'User-Agent': self.session.session.user_agent}
+
+        # only worth it if the CDN supports Range requests and the file has more than one segment
+        try:
+            size = self.downloader.probe(stream_url, headers) if self.downloader.segments > 1 else None
+            if size and len(self.downloader.split(size)) > 1:
+                temp_file_path = create_temp_filename()
+                self.downloader.download(stream_url, temp_file_path, size, headers)
+
+                return TrackDownloadInfo(
+                    download_type=DownloadEnum.TEMP_FILE_PATH,
+                    temp_file_path=temp_file_path
+                )
+        except (requests.RequestException, ConnectionError, OSError) as e:
+            # Orpheus downloads the stream url itself then
+            logging.debug(f'{module_information.service_name}: segmented download failed, falling back: {e}')
+
         return TrackDownloadInfo(
             download_type=DownloadEnum.URL,
             file_url=stream_url,
-            file_url_headers={'User-Agent': self.session.session.user_agent}
+            file_url_headers=headers
         )
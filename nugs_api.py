@@ -1,11 +1,17 @@
 import hashlib
 import json
+import math
 import re
 import secrets
+import threading
+import time
 from abc import ABC, abstractmethod
 from base64 import b64decode, urlsafe_b64encode
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
 
 import requests
 from requests.adapters import HTTPAdapter
@@ -13,6 +19,14 @@ import urllib.parse as urlparse
 from urllib.parse import parse_qs
 from urllib3 import Retry
 
+from .nugs_metrics import metrics
+
+try:
+    import ijson
+    from ijson.common import ObjectBuilder
+except ImportError:
+    ijson = None
+
 
 @dataclass
 class NugsSubscription:
@@ -22,16 +36,258 @@ class NugsSubscription:
     end_stamp: int
 
 
+@dataclass
+class NugsTrack:
+    """
+    Compact song of a container, only holds the fields the interface reads
+    """
+    __slots__ = ['song_id', 'track_id', 'song_title', 'track_num', 'disc_num', 'album_id']
+    song_id: int
+    track_id: int
+    song_title: str
+    track_num: int
+    disc_num: int
+    album_id: str
+
+    @classmethod
+    def from_dict(cls, song: dict, album_id: str = None):
+        return cls(
+            song_id=song.get('songID'),
+            track_id=song.get('trackID'),
+            song_title=song.get('songTitle'),
+            track_num=song.get('trackNum'),
+            disc_num=song.get('discNum'),
+            album_id=album_id if album_id is not None else song.get('albumID', song.get('containerID'))
+        )
+
+    def to_dict(self) -> dict:
+        return {'songID': self.song_id, 'trackID': self.track_id, 'songTitle': self.song_title,
+                'trackNum': self.track_num, 'discNum': self.disc_num, 'albumID': self.album_id}
+
+
+@dataclass
+class NugsAlbum:
+    """
+    Compact container (album), only holds the fields the interface reads
+    """
+    __slots__ = ['container_id', 'container_info', 'artist_name', 'artist_id', 'release_date_formatted', 'img_url',
+                 'licensor_name', 'tracks']
+    container_id: str
+    container_info: str
+    artist_name: str
+    artist_id: str
+    release_date_formatted: str
+    img_url: str
+    licensor_name: str
+    tracks: tuple
+
+    @classmethod
+    def from_dict(cls, container: dict):
+        return cls(
+            container_id=container.get('containerID'),
+            container_info=container.get('containerInfo'),
+            artist_name=container.get('artistName'),
+            artist_id=container.get('artistID'),
+            release_date_formatted=container.get('releaseDateFormatted'),
+            img_url=(container.get('img') or {}).get('url'),
+            licensor_name=container.get('licensorName'),
+            tracks=tuple(NugsTrack.from_dict(s, container.get('containerID')) for s in container.get('songs') or [])
+        )
+
+    def to_dict(self) -> dict:
+        # same keys as the API, so from_dict() can read it again
+        return {'containerID': self.container_id, 'containerInfo': self.container_info,
+                'artistName': self.artist_name, 'artistID': self.artist_id,
+                'releaseDateFormatted': self.release_date_formatted, 'img': {'url': self.img_url},
+                'licensorName': self.licensor_name, 'songs': [t.to_dict() for t in self.tracks]}
+
+
 class NugsNotAvailableError(Exception):
     def __init__(self, message):
         super(NugsNotAvailableError, self).__init__(message)
 
 
+def create_nugs_session(pool_maxsize: int = 16, host_pool_sizes: dict = None) -> requests.Session:
+    """
+    Creates the keep-alive requests session shared by all nugs hosts, every host gets its own connection pool
+    """
+    s = requests.Session()
+
+    retries = Retry(total=10,
+                    backoff_factor=0.4,
+                    status_forcelist=[429, 500, 502, 503, 504])
+
+    # streamapi.nugs.net and the CDN hosts are used by all workers, so they get the default (big) pools
+    s.mount('http://', HTTPAdapter(pool_connections=8, pool_maxsize=pool_maxsize, max_retries=retries))
+    s.mount('https://', HTTPAdapter(pool_connections=8, pool_maxsize=pool_maxsize, max_retries=retries))
+
+    # the auth and subscription hosts are only called once in a while
+    if host_pool_sizes is None:
+        host_pool_sizes = {'https://id.nugs.net/': 2, 'https://subscriptions.nugs.net/': 2}
+
+    for prefix, pool_size in host_pool_sizes.items():
+        s.mount(prefix, HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retries))
+
+    # 429 and 5xx of streamapi.nugs.net are handled by the NugsRateLimiter in NugsApi._get, so only retry on
+    # connection errors here
+    s.mount(NugsApi.API_URL, HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize,
+                                         max_retries=Retry(total=3, backoff_factor=0.4, status_forcelist=[])))
+
+    return s
+
+
+class NugsRateLimiter:
+    """
+    Token bucket with AIMD adaptive concurrency: the number of concurrent requests grows while the responses are healthy
+    and is halved on 429 or 5xx, a Retry-After header blocks all callers until it passed
+    """
+    def __init__(self, rate: float = 25, burst: int = 25, concurrency: int = 8, min_concurrency: int = 1,
+                 max_concurrency: int = 32):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+
+        self.concurrency = concurrency
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.in_flight = 0
+
+        self.condition = threading.Condition()
+
+    @staticmethod
+    def parse_retry_after(retry_after: str or None) -> float or None:
+        # Retry-After is either in seconds or a HTTP date
+        if not retry_after:
+            return None
+        try:
+            return max(float(retry_after), 0)
+        except ValueError:
+            try:
+                return max(parsedate_to_datetime(retry_after).timestamp() - time.time(), 0)
+            except (TypeError, ValueError):
+                return None
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if now >= self.blocked_until and self.tokens >= 1 and self.in_flight < int(self.concurrency):
+                    self.tokens -= 1
+                    self.in_flight += 1
+                    return
+
+                # wait until the next token is available, the Retry-After passed or a request finished
+                wait = max(self.blocked_until - now, (1 - self.tokens) / self.rate, 0.01)
+                self.condition.wait(wait)
+
+    def release(self, status_code: int or None = None, retry_after: str = None):
+        with self.condition:
+            self.in_flight -= 1
+
+            if status_code == 429 or (status_code is not None and status_code >= 500):
+                # multiplicative decrease
+                self.concurrency = max(self.min_concurrency, self.concurrency / 2)
+
+                delay = self.parse_retry_after(retry_after)
+                if delay is None and status_code == 429:
+                    delay = 1
+                if delay:
+                    self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+            elif status_code is not None:
+                # additive increase, roughly one more concurrent request per "round" of healthy responses
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+
+            self.condition.notify_all()
+
+
+class NugsLruCache:
+    """
+    Thread-safe LRU cache bounded by entry count and (JSON) bytes, concurrent fetches of the same key are coalesced.
+    Entries older than the optional ttl (seconds) are fetched again
+    """
+    def __init__(self, name: str, max_entries: int = 256, max_bytes: int = 64 * 1024 * 1024, ttl: int = None):
+        # the name is used for the cache hit/miss metrics
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.in_flight = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, fetch):
+        with self.lock:
+            if key in self.entries and self.ttl is not None and \
+                    time.monotonic() - self.entries[key][2] > self.ttl:
+                self.bytes -= self.entries.pop(key)[1]
+
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                metrics.count('cache_hits', cache=self.name)
+                return self.entries[key][0]
+
+            metrics.count('cache_misses', cache=self.name)
+
+            # single-flight: only the first caller fetches, all others wait for its result
+            future = self.in_flight.get(key)
+            if future is not None:
+                owner = False
+            else:
+                owner = True
+                future = self.in_flight[key] = Future()
+
+        if not owner:
+            return future.result()
+
+        try:
+            value = fetch()
+            # store the value before the key leaves in_flight, so no caller can start a second fetch in between
+            self.put(key, value)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(value)
+        finally:
+            with self.lock:
+                self.in_flight.pop(key, None)
+        return value
+
+    def put(self, key, value):
+        size = len(json.dumps(value, default=lambda o: o.to_dict()))
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= self.entries.pop(key)[1]
+
+            # a single entry bigger than the whole cache is never stored
+            if size > self.max_bytes:
+                return
+
+            self.entries[key] = (value, size, time.monotonic())
+            self.bytes += size
+
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                self.bytes -= self.entries.popitem(last=False)[1][1]
+
+
 class NugsSession(ABC):
     """
     Nugs abstract session object with all (abstract) functions needed: auth_headers(), refresh()
     """
-    def __init__(self):
+    NUGS_AUTH_BASE = 'https://id.nugs.net'
+    SUBSCRIPTIONS_URL = 'https://subscriptions.nugs.net/api/v1/me/subscriptions/'
+
+    def __init__(self, s: requests.Session = None):
+        # the shared keep-alive session, also used by NugsApi
+        self.s = s if s is not None else create_nugs_session()
+
         self.user_agent = None
 
         self.access_token = None
@@ -76,7 +332,7 @@ class NugsSession(ABC):
         Returns the user data.
         """
         if self.access_token:
-            r = requests.get('https://id.nugs.net/connect/userinfo', headers=self.auth_headers())
+            r = self.s.get(f'{self.NUGS_AUTH_BASE}/connect/userinfo', headers=self.auth_headers())
 
             if r.status_code != 200:
                 raise Exception(r.json())
@@ -88,7 +344,7 @@ class NugsSession(ABC):
         Returns the subscription status of the user.
         """
         if self.access_token:
-            r = requests.get('https://subscriptions.nugs.net/api/v1/me/subscriptions/', headers=self.auth_headers())
+            r = self.s.get(self.SUBSCRIPTIONS_URL, headers=self.auth_headers())
 
             if r.status_code != 200:
                 raise Exception(r.json())
@@ -118,23 +374,169 @@ class NugsSession(ABC):
 class NugsApi:
     API_URL = 'https://streamapi.nugs.net/'
 
-    def __init__(self, session: NugsSession):
+    # process-wide album container cache, shared by all NugsApi objects
+    album_cache = NugsLruCache('album')
+    # process-wide catalog.search cache, one response holds the results of all query types
+    search_cache = NugsLruCache('search', ttl=60 * 60)
+    # process-wide rate limiter, so all workers together stay below the streamapi.nugs.net limits
+    rate_limiter = NugsRateLimiter()
+    # attempts for a request which returned 429 or 5xx
+    max_attempts = 6
+
+    def __init__(self, session: NugsSession, cache=None, album_ttl: int = 7 * 24 * 60 * 60,
+                 on_token_refresh=None, refresh_skew: int = 5 * 60, search_ttl: int = 60 * 60):
         self.session = session
 
-        self.s = requests.Session()
+        # refresh the access_token refresh_skew seconds before it expires, on_token_refresh(session) is called after
+        # every refresh so the new tokens can be saved
+        self.on_token_refresh = on_token_refresh
+        self.refresh_skew = timedelta(seconds=refresh_skew)
+        self.token_lock = threading.Lock()
+
+        # optional persistent NugsCache for the album containers and searches
+        self.cache = cache
+        self.album_ttl = album_ttl
+        self.search_ttl = search_ttl
 
-        retries = Retry(total=10,
-                        backoff_factor=0.4,
-                        status_forcelist=[429, 500, 502, 503, 504])
+        # use the same connection pools as the session
+        self.s = session.s
 
-        self.s.mount('http://', HTTPAdapter(max_retries=retries))
-        self.s.mount('https://', HTTPAdapter(max_retries=retries))
+    def token_expiring(self) -> bool:
+        return self.session.refresh_token is not None and self.session.expires is not None and \
+               datetime.now() + self.refresh_skew >= self.session.expires
+
+    def refresh_token(self, force: bool = False, expired_token: str = None):
+        """
+        Refreshes the access_token if it (almost) expired, concurrent callers only trigger a single refresh
+        """
+        if expired_token is None:
+            expired_token = self.session.access_token
+
+        with self.token_lock:
+            # another thread already refreshed the token while this one was waiting for the lock
+            if self.session.access_token != expired_token:
+                return
+            if not force and not self.token_expiring():
+                return
+
+            self.session.refresh()
+
+            if self.on_token_refresh:
+                self.on_token_refresh(self.session)
+
+    def _request(self, url: str, params: dict, headers: dict = None, stream: bool = False) -> requests.Response:
+        # all requests to streamapi.nugs.net go through the rate limiter, 429 and 5xx are retried here
+        r = None
+        for attempt in range(self.max_attempts):
+            self.rate_limiter.acquire()
+            start = time.perf_counter()
+            try:
+                r = self.s.get(f'{self.API_URL}{url}', params=params, stream=stream,
+                               headers={**self.session.auth_headers(), **(headers or {})})
+            except Exception:
+                self.rate_limiter.release()
+                metrics.observe_request(url, params.get('method'), time.perf_counter() - start, None, 0, attempt)
+                raise
+            self.rate_limiter.release(r.status_code, r.headers.get('Retry-After'))
+
+            # streamed bodies aren't downloaded yet, so only the Content-Length is known
+            size = int(r.headers.get('Content-Length') or (0 if stream else len(r.content)))
+            metrics.observe_request(url, params.get('method'), time.perf_counter() - start, r.status_code, size,
+                                    attempt)
+
+            if r.status_code == 429:
+                # the rate limiter already waits for the Retry-After
+                r.close()
+                continue
+            if r.status_code in {500, 502, 503, 504}:
+                r.close()
+                # no need to wait if no attempt follows
+                if attempt < self.max_attempts - 1:
+                    time.sleep(0.4 * (2 ** attempt))
+                continue
+            break
+
+        return r
+
+    def _send(self, url: str, params, headers: dict = None, stream: bool = False) -> requests.Response:
+        # params can also be a function which builds them, for params which contain a token
+        build_params = params if callable(params) else lambda: params
+
+        if self.token_expiring():
+            self.refresh_token()
+
+        access_token = self.session.access_token
+        r = self._request(url, build_params(), headers, stream)
+
+        # the token got revoked or expired anyway, so refresh it and try again once with the new token
+        if r.status_code == 401 and self.session.refresh_token is not None:
+            r.close()
+            self.refresh_token(force=True, expired_token=access_token)
+            r = self._request(url, build_params(), headers, stream)
+
+        return r
+
+    @staticmethod
+    def _parse_items(r: requests.Response, key: str, meta: dict = None):
+        """
+        Yields the items of Response[key] while the (gzip) body is still downloading, all other scalars of Response
+        (like totalMatchedRecords) are saved in meta. Without ijson the whole body is parsed at once.
+        """
+        if meta is None:
+            meta = {}
+
+        try:
+            if ijson is None:
+                response = r.json()
+                if response.get('responseAvailabilityCode') != 0:
+                    raise NugsNotAvailableError(response.get('responseAvailabilityCodeStr'))
+
+                meta.update({k: v for k, v in response.get('Response').items() if not isinstance(v, (dict, list))})
+                yield from response.get('Response').get(key) or []
+                return
+
+            # let urllib3 decompress the gzip stream
+            r.raw.decode_content = True
+
+            item_prefix = f'Response.{key}.item'
+            availability_code, availability_str, builder = None, None, None
+            for prefix, event, value in ijson.parse(r.raw, use_float=True):
+                if builder is not None:
+                    builder.event(event, value)
+                    if prefix == item_prefix and event in {'end_map', 'end_array'}:
+                        yield builder.value
+                        builder = None
+                elif prefix == item_prefix and event in {'start_map', 'start_array'}:
+                    builder = ObjectBuilder()
+                    builder.event(event, value)
+                elif prefix == 'responseAvailabilityCode':
+                    availability_code = value
+                    if availability_code != 0:
+                        break
+                elif prefix == 'responseAvailabilityCodeStr':
+                    availability_str = value
+                elif prefix.count('.') == 1 and prefix.startswith('Response.') and event not in {
+                        'start_map', 'start_array', 'end_map', 'end_array', 'map_key'}:
+                    meta[prefix[len('Response.'):]] = value
+
+            if availability_code != 0:
+                raise NugsNotAvailableError(availability_str)
+        finally:
+            r.close()
+
+    def _iter_items(self, url: str, params: dict, key: str, meta: dict = None):
+        r = self._send(url, params, stream=True)
+
+        if r.status_code not in {200, 201, 202}:
+            raise ConnectionError(r.text)
+
+        yield from self._parse_items(r, key, meta)
 
     def _get(self, url: str = '', params=None, parse_response: bool = True):
         if not params:
             params = {}
 
-        r = self.s.get(f'{self.API_URL}{url}', params=params, headers=self.session.auth_headers())
+        r = self._send(url, params)
 
         if r.status_code not in {200, 201, 202}:
             raise ConnectionError(r.text)
@@ -147,15 +549,30 @@ class NugsApi:
 
         return r.json()
 
-    def get_album(self, album_id: str):
-        return self._get('api.aspx', {
+    def get_album(self, album_id: str) -> NugsAlbum:
+        return self.album_cache.get(str(album_id), lambda: self._fetch_album(album_id))
+
+    def _fetch_album(self, album_id: str) -> NugsAlbum:
+        album_data = self.cache.get_album(album_id, self.album_ttl) if self.cache else None
+        if album_data is not None:
+            metrics.count('cache_hits', cache='album_disk')
+            return NugsAlbum.from_dict(album_data)
+        if self.cache:
+            metrics.count('cache_misses', cache='album_disk')
+
+        album = NugsAlbum.from_dict(self._get('api.aspx', {
             'method': 'catalog.container',
             'containerID': album_id,
             'vdisp': 1
-        })
+        }))
+
+        if self.cache:
+            self.cache.set_album(album_id, album.to_dict())
+        return album
 
     def get_user_playlist(self, playlist_id: str):
-        return self._get('secureApi.aspx', {
+        # the legacy token is part of the params, so they are built again after every token refresh
+        return self._get('secureApi.aspx', lambda: {
             'method': 'user.playlist',
             'playlistID': playlist_id,
             'token': self.session.get_legacy_token(),
@@ -170,15 +587,78 @@ class NugsApi:
             'limit': '10',
         })
 
-    def get_artist_albums(self, artist_id: str, offset: int = 1, limit: int = 100):
-        return self._get('api.aspx', {
+    def iter_artist_albums_page(self, artist_id: str, offset: int = 1, limit: int = 100, meta: dict = None):
+        """
+        Yields the containers of one catalog.containersAll page while the page is downloading
+        """
+        return self._iter_items('api.aspx', {
             'method': 'catalog.containersAll',
             'startOffset': offset,
             'artistList': artist_id,
             'limit': limit,
             'vdisp': '1',
-            'availType':  '1'
-        })
+            'availType': '1'
+        }, 'containers', meta)
+
+    def iter_artist_albums(self, artist_id: str, limit: int = 100, max_workers: int = 4, known_ids: set = None,
+                           newest_date: str = None, pending_ids: set = None, on_page=None):
+        """
+        Yields all containers of the artist in order, all pages after the first one are fetched concurrently. With
+        known_ids only the new containers are yielded, see iter_new_artist_albums. on_page(listed, total) is called
+        after every page
+        """
+        if known_ids is not None:
+            yield from self.iter_new_artist_albums(artist_id, known_ids, newest_date, limit, pending_ids, on_page)
+            return
+
+        meta = {}
+        yield from self.iter_artist_albums_page(artist_id, limit=limit, meta=meta)
+
+        total = meta.get('totalMatchedRecords') or 0
+        if on_page:
+            on_page(min(limit, total), total)
+
+        total_pages = math.ceil(total / limit)
+        if total_pages < 2:
+            return
+
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='nugs-pages') as executor:
+            pages = executor.map(lambda page: list(self.iter_artist_albums_page(artist_id, offset=page, limit=limit)),
+                                 range(2, total_pages + 1))
+            for page_number, page in enumerate(pages, start=2):
+                yield from page
+                if on_page:
+                    on_page(min(page_number * limit, total), total)
+
+    def iter_new_artist_albums(self, artist_id: str, known_ids: set, newest_date: str = None, limit: int = 100,
+                               pending_ids: set = None, on_page=None):
+        """
+        Yields the containers which aren't in known_ids (str containerIDs). The pages are ordered newest first, so
+        they are fetched one after another and the pagination stops at the first page which reaches a known
+        container or one released before newest_date. Known containers which are in pending_ids are yielded as well
+        """
+        page = 1
+        while True:
+            meta = {}
+            reached_known = False
+            for container in self.iter_artist_albums_page(artist_id, offset=page, limit=limit, meta=meta):
+                if str(container.get('containerID')) in known_ids:
+                    reached_known = True
+                    if str(container.get('containerID')) in (pending_ids or ()):
+                        yield container
+                    continue
+                # a new container with an old release date (e.g. an archive release) is still new
+                if newest_date and (container.get('releaseDateFormatted') or newest_date) < newest_date:
+                    reached_known = True
+                yield container
+
+            total = meta.get('totalMatchedRecords') or 0
+            if on_page:
+                on_page(min(page * limit, total), total)
+
+            if reached_known or page * limit >= total:
+                return
+            page += 1
 
     def get_stream(self, track_id: str, sub: NugsSubscription, quality: int or None = 8):
         # quality can be 2, 5, 8, 9 or None
@@ -193,16 +673,59 @@ class NugsApi:
             'platformID': quality
         }, parse_response=False)
 
+    @staticmethod
+    def normalize_query(query: str) -> str:
+        # catalog.search ignores the case and the whitespace
+        return ' '.join(query.casefold().split())
+
     def get_search(self, query: str):
-        return self._get('api.aspx', {
+        return self.search_cache.get(self.normalize_query(query), lambda: self._fetch_search(query))
+
+    def _fetch_search(self, query: str):
+        query_key = self.normalize_query(query)
+        results = self.cache.get_search(query_key, self.search_ttl) if self.cache else None
+        if results is not None:
+            metrics.count('cache_hits', cache='search_disk')
+            return results
+        if self.cache:
+            metrics.count('cache_misses', cache='search_disk')
+
+        results = self._get('api.aspx', {
             'method': 'catalog.search',
             'searchStr': query
         })
+        if self.cache:
+            self.cache.set_search(query_key, results)
+        return results
 
-    def get_all_artists(self):
-        return self._get('api.aspx', {
-            'method': 'catalog.artists'
-        })
+    def get_searches(self, queries: list, max_workers: int = 8) -> dict:
+        """
+        Searches all queries concurrently (the rate limiter still applies) and returns {query: results}
+        """
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='nugs-search') as executor:
+            # queries which only differ in case or whitespace are only searched once
+            futures = {}
+            for query in queries:
+                query_key = self.normalize_query(query)
+                if query_key not in futures:
+                    futures[query_key] = executor.submit(self.get_search, query)
+            return {query: futures[self.normalize_query(query)].result() for query in queries}
+
+    def get_all_artists_conditional(self, etag: str = None):
+        """
+        Returns (artists, etag) of catalog.artists, artists is None if the ETag still matches (304 Not Modified),
+        otherwise it's a generator which yields the artists while they are downloading
+        """
+        r = self._send('api.aspx', {'method': 'catalog.artists'}, headers={'If-None-Match': etag} if etag else None,
+                       stream=True)
+
+        if r.status_code == 304:
+            r.close()
+            return None, etag
+        if r.status_code not in {200, 201, 202}:
+            raise ConnectionError(r.text)
+
+        return self._parse_items(r, 'artists'), r.headers.get('ETag')
 
 
 class NugsMobileSession(NugsSession):
@@ -210,10 +733,8 @@ class NugsMobileSession(NugsSession):
     Nugs session object based on the mobile Android oauth flow
     """
 
-    def __init__(self, client_id: str, dev_key: str):
-        super().__init__()
-
-        self.NUGS_AUTH_BASE = 'https://id.nugs.net'
+    def __init__(self, client_id: str, dev_key: str, s: requests.Session = None):
+        super().__init__(s)
 
         self.client_id = client_id
         self.dev_key = dev_key
@@ -225,6 +746,7 @@ class NugsMobileSession(NugsSession):
                           'Chrome/103.0.0.0 Mobile Safari/537.36'
 
     def auth(self, username: str, password: str):
+        # the login flow needs its own cookies, so don't use the shared session here
         s = requests.Session()
         s.headers.update({'User-Agent': self.user_agent})
 
@@ -296,15 +818,12 @@ class NugsMobileSession(NugsSession):
         self.get_user()
 
     def refresh(self):
-        s = requests.Session()
-        s.headers.update({'User-Agent': self.user_agent})
-
         # exchange the code for access token
-        r = s.post(f'{self.NUGS_AUTH_BASE}/connect/token', data={
+        r = self.s.post(f'{self.NUGS_AUTH_BASE}/connect/token', data={
             'refresh_token': self.refresh_token,
             'client_id': self.client_id,
             'grant_type': 'refresh_token'
-        })
+        }, headers={'User-Agent': self.user_agent})
 
         assert (r.status_code == 200)
 
@@ -0,0 +1,409 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from abc import ABC, abstractmethod
+
+from .nugs_metrics import metrics
+
+
+class NugsCache:
+    """
+    Persistent SQLite cache for everything that doesn't change between runs, shared by all threads
+    """
+    def __init__(self, path: str):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS stream_formats (
+                track_id TEXT NOT NULL,
+                plan_id TEXT NOT NULL,
+                formats TEXT NOT NULL,
+                complete INTEGER NOT NULL,
+                updated INTEGER NOT NULL,
+                PRIMARY KEY (track_id, plan_id)
+            );
+            CREATE TABLE IF NOT EXISTS artists (
+                artist_id TEXT PRIMARY KEY,
+                artist_name TEXT NOT NULL,
+                num_albums INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS albums (
+                album_id TEXT PRIMARY KEY,
+                data TEXT NOT NULL,
+                updated INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS mqa (
+                track_id TEXT NOT NULL,
+                format_key TEXT NOT NULL,
+                is_mqa INTEGER NOT NULL,
+                bit_depth INTEGER,
+                sample_rate REAL,
+                PRIMARY KEY (track_id, format_key)
+            );
+            CREATE TABLE IF NOT EXISTS searches (
+                query TEXT PRIMARY KEY,
+                data TEXT NOT NULL,
+                updated INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS covers (
+                url TEXT PRIMARY KEY,
+                hash TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                used INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS artist_sync (
+                artist_id TEXT PRIMARY KEY,
+                album_ids TEXT NOT NULL,
+                pending_ids TEXT NOT NULL,
+                newest_date TEXT,
+                updated INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS platform_formats (
+                scope TEXT NOT NULL,
+                platform_id TEXT NOT NULL,
+                format_key TEXT NOT NULL,
+                hits INTEGER NOT NULL,
+                PRIMARY KEY (scope, platform_id, format_key)
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+            CREATE TABLE IF NOT EXISTS catalog_albums (
+                album_id TEXT PRIMARY KEY,
+                artist_id TEXT
+            );
+            CREATE INDEX IF NOT EXISTS catalog_albums_artist_id ON catalog_albums (artist_id);
+            CREATE TABLE IF NOT EXISTS catalog_tracks (
+                song_id TEXT PRIMARY KEY,
+                album_id TEXT NOT NULL
+            );
+        ''')
+
+        # full-text tables of the catalog mirror, their rowids are the artistIDs, containerIDs and songIDs. FTS5 is
+        # part of nearly every SQLite build, otherwise it falls back to LIKE
+        try:
+            for table in ('artists_fts', 'albums_fts', 'tracks_fts'):
+                self.db.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {table} USING fts5(text, "
+                                f"tokenize='unicode61 remove_diacritics 2')")
+            self.fts = True
+        except sqlite3.OperationalError:
+            for table in ('artists_fts', 'albums_fts', 'tracks_fts'):
+                self.db.execute(f'CREATE TABLE IF NOT EXISTS {table} (text TEXT)')
+            self.fts = False
+        self.db.commit()
+
+    def _execute(self, sql: str, params=()):
+        with self.lock:
+            cursor = self.db.execute(sql, params)
+            self.db.commit()
+            return cursor.fetchall()
+
+    def get_stream_formats(self, track_id: str, plan_id: str, ttl: int):
+        """
+        Returns ({format_key: platform_id}, complete) or None if the track isn't cached or expired
+        """
+        rows = self._execute('SELECT formats, complete FROM stream_formats WHERE track_id = ? AND plan_id = ? '
+                             'AND updated > ?', (str(track_id), str(plan_id), int(time.time()) - ttl))
+        if not rows:
+            return None
+        return json.loads(rows[0][0]), bool(rows[0][1])
+
+    def set_stream_formats(self, track_id: str, plan_id: str, formats: dict, complete: bool):
+        self._execute('INSERT OR REPLACE INTO stream_formats VALUES (?, ?, ?, ?, ?)',
+                      (str(track_id), str(plan_id), json.dumps(formats), int(complete), int(time.time())))
+
+    def delete_stream_formats(self, track_id: str, plan_id: str):
+        self._execute('DELETE FROM stream_formats WHERE track_id = ? AND plan_id = ?', (str(track_id), str(plan_id)))
+
+    def get_album(self, album_id: str, ttl: int = None):
+        # without a ttl expired albums are returned as well
+        if ttl is None:
+            rows = self._execute('SELECT data FROM albums WHERE album_id = ?', (str(album_id),))
+        else:
+            rows = self._execute('SELECT data FROM albums WHERE album_id = ? AND updated > ?',
+                                 (str(album_id), int(time.time()) - ttl))
+        return json.loads(rows[0][0]) if rows else None
+
+    def set_album(self, album_id: str, album_data: dict):
+        self._execute('INSERT OR REPLACE INTO albums VALUES (?, ?, ?)',
+                      (str(album_id), json.dumps(album_data), int(time.time())))
+
+
+    def get_mqa(self, track_id: str, format_key: str):
+        rows = self._execute('SELECT is_mqa, bit_depth, sample_rate FROM mqa WHERE track_id = ? AND format_key = ?',
+                             (str(track_id), format_key))
+        if not rows:
+            return None
+        return {'is_mqa': bool(rows[0][0]), 'bit_depth': rows[0][1], 'sample_rate': rows[0][2]}
+
+    def set_mqa(self, track_id: str, format_key: str, mqa_info: dict):
+        self._execute('INSERT OR REPLACE INTO mqa VALUES (?, ?, ?, ?, ?)', (
+            str(track_id), format_key, int(mqa_info['is_mqa']), mqa_info['bit_depth'], mqa_info['sample_rate']))
+
+    def get_search(self, query: str, ttl: int):
+        rows = self._execute('SELECT data FROM searches WHERE query = ? AND updated > ?',
+                             (query, int(time.time()) - ttl))
+        return json.loads(rows[0][0]) if rows else None
+
+    def set_search(self, query: str, results: dict):
+        self._execute('INSERT OR REPLACE INTO searches VALUES (?, ?, ?)', (query, json.dumps(results), int(time.time())))
+
+    def get_cover(self, url: str):
+        # returns the content hash of the cover and marks it as used
+        with self.lock:
+            rows = self.db.execute('SELECT hash FROM covers WHERE url = ?', (url,)).fetchall()
+            if rows:
+                self.db.execute('UPDATE covers SET used = ? WHERE hash = ?', (int(time.time()), rows[0][0]))
+                self.db.commit()
+        return rows[0][0] if rows else None
+
+    def set_cover(self, url: str, content_hash: str, size: int):
+        self._execute('INSERT OR REPLACE INTO covers VALUES (?, ?, ?, ?)', (url, content_hash, size, int(time.time())))
+
+    def evict_covers(self, max_bytes: int) -> list:
+        """
+        Removes the least recently used covers until all files fit into max_bytes, returns their hashes
+        """
+        with self.lock:
+            total, evicted = 0, []
+            for content_hash, size in self.db.execute('SELECT hash, MAX(size) FROM covers GROUP BY hash '
+                                                      'ORDER BY MAX(used) DESC').fetchall():
+                total += size
+                if total > max_bytes:
+                    evicted.append(content_hash)
+            if evicted:
+                self.db.executemany('DELETE FROM covers WHERE hash = ?', [(h,) for h in evicted])
+                self.db.commit()
+        return evicted
+
+    def get_artist_sync(self, artist_id: str):
+        """
+        Returns (set of processed containerIDs, set of listed but not processed containerIDs, newest processed
+        release date) of the incremental syncs or None
+        """
+        rows = self._execute('SELECT album_ids, pending_ids, newest_date FROM artist_sync WHERE artist_id = ?',
+                             (str(artist_id),))
+        if not rows:
+            return None
+        return set(json.loads(rows[0][0])), set(json.loads(rows[0][1])), rows[0][2]
+
+    def set_artist_sync(self, artist_id: str, album_ids: set, pending_ids: set, newest_date: str or None):
+        self._execute('INSERT OR REPLACE INTO artist_sync VALUES (?, ?, ?, ?, ?)', (
+            str(artist_id), json.dumps(sorted(album_ids)), json.dumps(sorted(pending_ids)), newest_date,
+            int(time.time())))
+
+    def confirm_artist_album(self, artist_id: str, album_id: str, release_date: str or None):
+        # moves a pending containerID to the processed ones, only those count for the high-water mark
+        with self.lock:
+            rows = self.db.execute('SELECT album_ids, pending_ids, newest_date FROM artist_sync WHERE artist_id = ?',
+                                   (str(artist_id),)).fetchall()
+            if not rows or str(album_id) not in json.loads(rows[0][1]):
+                return
+
+            album_ids, pending_ids = set(json.loads(rows[0][0])), set(json.loads(rows[0][1]))
+            album_ids.add(str(album_id))
+            pending_ids.discard(str(album_id))
+            newest_date = max(filter(None, [rows[0][2], release_date]), default=None)
+
+            self.db.execute('INSERT OR REPLACE INTO artist_sync VALUES (?, ?, ?, ?, ?)', (
+                str(artist_id), json.dumps(sorted(album_ids)), json.dumps(sorted(pending_ids)), newest_date,
+                int(time.time())))
+            self.db.commit()
+
+    def get_platform_formats(self, scope: str) -> list:
+        """
+        Returns all (platform_id, format_key, hits) observed for an artist/licensor scope
+        """
+        return self._execute('SELECT platform_id, format_key, hits FROM platform_formats WHERE scope = ?', (scope,))
+
+    def add_platform_formats(self, scopes: list, observed: dict):
+        # observed is {platform_id: format_key}, every observation counts once for every scope
+        with self.lock:
+            self.db.executemany('INSERT INTO platform_formats VALUES (?, ?, ?, 1) '
+                                'ON CONFLICT (scope, platform_id, format_key) DO UPDATE SET hits = hits + 1',
+                                [(scope, str(p), k) for scope in scopes for p, k in observed.items()])
+            self.db.commit()
+
+    def get_meta(self, key: str):
+        rows = self._execute('SELECT value FROM meta WHERE key = ?', (key,))
+        return rows[0][0] if rows else None
+
+    def set_meta(self, key: str, value):
+        self._execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, None if value is None else str(value)))
+
+    def set_catalog_artists(self, artists: list):
+        # artists is [(artist_id, artist_name)], replaces all searchable artists
+        with self.lock:
+            self.db.execute('DELETE FROM artists_fts')
+            self.db.executemany('INSERT INTO artists_fts (rowid, text) VALUES (?, ?)',
+                                [(int(artist_id), artist_name) for artist_id, artist_name in artists])
+            self.db.commit()
+
+    def add_catalog_albums(self, albums: list):
+        """
+        Stores the NugsAlbums in the albums table and adds them, their artists and tracks to the full-text index, all
+        in one transaction
+        """
+        now = int(time.time())
+        with self.lock:
+            for album in albums:
+                album_id = int(album.container_id)
+                self.db.execute('INSERT OR REPLACE INTO albums VALUES (?, ?, ?)',
+                                (str(album_id), json.dumps(album.to_dict()), now))
+                self.db.execute('INSERT OR REPLACE INTO catalog_albums VALUES (?, ?)', (
+                    str(album_id), None if album.artist_id is None else str(album.artist_id)))
+                # the artists of the mirrored albums are searchable before catalog.artists was mirrored
+                if album.artist_id is not None:
+                    self.db.execute('DELETE FROM artists_fts WHERE rowid = ?', (int(album.artist_id),))
+                    self.db.execute('INSERT INTO artists_fts (rowid, text) VALUES (?, ?)',
+                                    (int(album.artist_id), album.artist_name))
+
+                self.db.execute('DELETE FROM albums_fts WHERE rowid = ?', (album_id,))
+                self.db.execute('INSERT INTO albums_fts (rowid, text) VALUES (?, ?)',
+                                (album_id, f'{album.artist_name} {album.container_info}'))
+
+                for track in album.tracks:
+                    self.db.execute('INSERT OR REPLACE INTO catalog_tracks VALUES (?, ?)',
+                                    (str(track.song_id), str(album_id)))
+                    self.db.execute('DELETE FROM tracks_fts WHERE rowid = ?', (int(track.song_id),))
+                    self.db.execute('INSERT INTO tracks_fts (rowid, text) VALUES (?, ?)',
+                                    (int(track.song_id), f'{track.song_title} {album.artist_name}'))
+            self.db.commit()
+
+    def match_catalog(self, kind: str, tokens: list, limit: int) -> list:
+        """
+        Returns the rowids of the artists, albums or tracks (kind) whose text contains all tokens, the last token can
+        be incomplete
+        """
+        table = {'artists': 'artists_fts', 'albums': 'albums_fts', 'tracks': 'tracks_fts'}[kind]
+        if not tokens:
+            return []
+
+        if self.fts:
+            match = ' '.join(f'"{token}"' for token in tokens) + '*'
+            rows = self._execute(f'SELECT rowid FROM {table} WHERE {table} MATCH ? ORDER BY rank LIMIT ?',
+                                 (match, limit))
+        else:
+            rows = self._execute(f'SELECT rowid FROM {table} WHERE ' + ' AND '.join(['text LIKE ?'] * len(tokens)) +
+                                 ' LIMIT ?', [f'%{token}%' for token in tokens] + [limit])
+        return [row[0] for row in rows]
+
+    def get_catalog_artist_name(self, artist_id: str):
+        rows = self._execute('SELECT text FROM artists_fts WHERE rowid = ?', (int(artist_id),))
+        return rows[0][0] if rows else None
+
+    def get_catalog_track_album_id(self, song_id: str):
+        rows = self._execute('SELECT album_id FROM catalog_tracks WHERE song_id = ?', (str(song_id),))
+        return rows[0][0] if rows else None
+
+    def get_catalog_artist_albums(self, artist_id: str) -> list:
+        """
+        Returns [(album_id, updated)] of the mirrored albums of the artist, updated is None if the album is missing
+        """
+        return self._execute('SELECT catalog_albums.album_id, albums.updated FROM catalog_albums '
+                             'LEFT JOIN albums USING (album_id) WHERE artist_id = ?', (str(artist_id),))
+
+    def get_catalog_artist_ids(self) -> list:
+        return [row[0] for row in self._execute('SELECT DISTINCT artist_id FROM catalog_albums '
+                                                'WHERE artist_id IS NOT NULL')]
+
+    def get_artists(self) -> list:
+        return self._execute('SELECT artist_id, artist_name, num_albums FROM artists')
+
+    def set_artists(self, artists: list):
+        with self.lock:
+            self.db.execute('DELETE FROM artists')
+            self.db.executemany('INSERT OR REPLACE INTO artists VALUES (?, ?, ?)', artists)
+            self.db.commit()
+
+
+class NugsBackgroundRefresh(ABC):
+    """
+    Runs self.refresh() in a daemon thread, at most once at a time
+    """
+    refresh_thread_name = 'nugs-refresh'
+    refresh_thread = None
+
+    @abstractmethod
+    def refresh(self):
+        pass
+
+    def _refresh_in_background(self):
+        if self.refresh_thread is None or not self.refresh_thread.is_alive():
+            self.refresh_thread = threading.Thread(target=self.refresh, name=self.refresh_thread_name, daemon=True)
+            self.refresh_thread.start()
+
+
+class NugsArtistIndex(NugsBackgroundRefresh):
+    """
+    Local index of catalog.artists by exact and normalized artistName, refreshed in the background after the ttl
+    """
+    refresh_thread_name = 'nugs-artists'
+
+    def __init__(self, api, cache: NugsCache, ttl: int):
+        self.api = api
+        self.cache = cache
+        self.ttl = ttl
+
+        self.by_name = {}
+        self.by_normalized_name = {}
+
+        self.lock = threading.Lock()
+
+        self._build(self.cache.get_artists())
+
+    @staticmethod
+    def normalize(name: str) -> str:
+        # "Grateful Dead", "grateful  dead" and "Gratéful Dead" all end up as "gratefuldead"
+        name = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').decode('ascii')
+        return re.sub(r'[\W_]+', '', name.casefold())
+
+    def _build(self, artists: list):
+        by_name, by_normalized_name = {}, {}
+        for artist_id, artist_name, num_albums in artists:
+            artist = {'artistID': artist_id, 'artistName': artist_name, 'numAlbums': num_albums}
+            by_name[artist_name] = artist
+            by_normalized_name.setdefault(self.normalize(artist_name), artist)
+
+        # swap both dicts at once, so lookups never see a half built index
+        self.by_name, self.by_normalized_name = by_name, by_normalized_name
+
+    def refresh(self):
+        with self.lock:
+            etag = self.cache.get_meta('artists_etag') if self.by_name else None
+            artists, etag = self.api.get_all_artists_conditional(etag)
+
+            # None means 304 Not Modified, the stored artists are still valid
+            if artists is not None:
+                artists = [(str(a.get('artistID')), a.get('artistName'), a.get('numAlbums')) for a in artists]
+                self.cache.set_artists(artists)
+                self._build(artists)
+
+            self.cache.set_meta('artists_etag', etag)
+            self.cache.set_meta('artists_updated', int(time.time()))
+
+    def lookup(self, artist_name: str):
+        """
+        Returns the artist dict with artistID, artistName and numAlbums or None if the artist is unknown
+        """
+        if not self.by_name:
+            self.refresh()
+        elif int(self.cache.get_meta('artists_updated') or 0) < time.time() - self.ttl:
+            self._refresh_in_background()
+
+        artist = self.by_name.get(artist_name)
+        if artist is None:
+            artist = self.by_normalized_name.get(self.normalize(artist_name))
+
+        metrics.count('cache_hits' if artist else 'cache_misses', cache='artist_index')
+        return artist
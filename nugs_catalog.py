@@ -0,0 +1,130 @@
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .nugs_api import NugsAlbum
+from .nugs_cache import NugsCache, NugsBackgroundRefresh
+from .nugs_metrics import metrics
+
+
+class NugsCatalogMirror(NugsBackgroundRefresh):
+    """
+    Local mirror of catalog.artists, catalog.containersAll and catalog.container with the full-text index of the
+    NugsCache, the albums themselves are the ones of the NugsCache albums table. Stream urls are always fetched live
+    """
+    refresh_thread_name = 'nugs-catalog'
+
+    def __init__(self, cache: NugsCache, api, artist_index, ttl: int = 24 * 60 * 60,
+                 album_ttl: int = 7 * 24 * 60 * 60):
+        self.cache = cache
+        self.api = api
+        self.artist_index = artist_index
+        self.ttl = ttl
+        self.album_ttl = album_ttl
+
+    def add_artists(self, artists: list):
+        # artists are dicts with artistID and artistName like catalog.artists
+        self.cache.set_catalog_artists([(a.get('artistID'), a.get('artistName')) for a in artists])
+
+    def add_albums(self, albums: list):
+        self.cache.add_catalog_albums(albums)
+
+    def get_album(self, album_id: str, expired: bool = False) -> NugsAlbum or None:
+        # albums older than album_ttl are fetched again, unless expired ones are fine (e.g. for the search)
+        album_data = self.cache.get_album(album_id, None if expired else self.album_ttl)
+        return NugsAlbum.from_dict(album_data) if album_data else None
+
+    def get_track_album(self, song_id: str) -> tuple:
+        """
+        Returns (NugsTrack, NugsAlbum) of the songID or (None, None) if it isn't mirrored, the album can be expired
+        """
+        album_id = self.cache.get_catalog_track_album_id(song_id)
+        album = self.get_album(album_id, expired=True) if album_id else None
+        if album is None:
+            return None, None
+        return next((t for t in album.tracks if str(t.song_id) == str(song_id)), None), album
+
+    def _match(self, kind: str, query: str, limit: int) -> list:
+        return self.cache.match_catalog(kind, re.findall(r'\w+', query.casefold()), limit)
+
+    def _search(self, query: str, limit: int) -> dict:
+        # {matchType: [matches]} with the artist names and the album and track items of catalog.search
+        artists = [self.cache.get_catalog_artist_name(artist_id) for artist_id in self._match('artists', query, limit)]
+
+        albums = [self.get_album(album_id, expired=True) for album_id in self._match('albums', query, limit)]
+        album_items = [{'containerID': a.container_id, 'artistName': a.artist_name, 'containerName': a.container_info}
+                       for a in albums if a]
+
+        track_items = []
+        for song_id in self._match('tracks', query, limit):
+            track, album = self.get_track_album(song_id)
+            if track:
+                track_items.append({**track.to_dict(), 'containerID': album.container_id,
+                                    'artistName': album.artist_name, 'containerName': album.container_info})
+
+        return {1: artists, 6: album_items, 2: track_items}
+
+    @staticmethod
+    def _new_matches(match_type: int, containers: list, matches: list) -> list:
+        # catalogSearchContainers with the local matches which aren't in the live containers yet
+        if match_type == 1:
+            live = {c.get('matchedStr') for c in containers}
+            return [{'matchedStr': name} for name in matches if name not in live]
+
+        id_key = 'containerID' if match_type == 6 else 'songID'
+        live = {str(i.get(id_key)) for c in containers for i in c.get('catalogSearchResultItems') or []}
+        new_items = [i for i in matches if str(i.get(id_key)) not in live]
+        return [{'catalogSearchResultItems': new_items}] if new_items else []
+
+    def search(self, query: str, results: dict, limit: int = 20) -> dict:
+        """
+        Adds the mirrored matches to a copy of the live catalog.search results, a partially mirrored artist would
+        otherwise hide the albums and tracks which weren't mirrored yet
+        """
+        if int(self.cache.get_meta('catalog_updated') or 0) < time.time() - self.ttl:
+            self._refresh_in_background()
+
+        local = self._search(query, limit)
+        merged, added = [], 0
+        for type_container in results.get('catalogSearchTypeContainers') or []:
+            match_type = type_container.get('matchType')
+            if match_type in local:
+                containers = type_container.get('catalogSearchContainers') or []
+                new_matches = self._new_matches(match_type, containers, local.pop(match_type))
+                added += len(new_matches)
+                type_container = {**type_container, 'catalogSearchContainers': containers + new_matches}
+            merged.append(type_container)
+
+        # the match types the API didn't return at all
+        for match_type, matches in local.items():
+            new_matches = self._new_matches(match_type, [], matches)
+            if new_matches:
+                added += len(new_matches)
+                merged.append({'matchType': match_type, 'catalogSearchContainers': new_matches})
+
+        metrics.count('cache_hits' if added else 'cache_misses', cache='catalog_mirror_search')
+        return {**results, 'catalogSearchTypeContainers': merged}
+
+    def sync_artist(self, artist_id: str):
+        # only the containers which are newer than the mirrored ones are fetched, the first sync and every sync after
+        # an album expired fetch all of them again
+        rows = self.cache.get_catalog_artist_albums(artist_id)
+        expired = any(updated is None or updated <= time.time() - self.album_ttl for _, updated in rows)
+        known_ids = {album_id for album_id, _ in rows} if rows and not expired else None
+
+        self.add_albums([NugsAlbum.from_dict(c) for c in self.api.iter_artist_albums(artist_id, known_ids=known_ids)
+                         if c.get('containerType') == 1])
+
+    def refresh(self, artist_ids: list = None, max_workers: int = 4):
+        """
+        Incremental refresh of catalog.artists and of the albums of artist_ids, by default all mirrored artists
+        """
+        self.artist_index.refresh()
+        self.add_artists(list(self.artist_index.by_name.values()))
+
+        if artist_ids is None:
+            artist_ids = self.cache.get_catalog_artist_ids()
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='nugs-catalog') as executor:
+            list(executor.map(self.sync_artist, artist_ids))
+
+        self.cache.set_meta('catalog_updated', int(time.time()))
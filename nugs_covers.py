@@ -0,0 +1,135 @@
+import hashlib
+import mimetypes
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from .nugs_api import NugsLruCache
+from .nugs_metrics import metrics
+
+
+class NugsCoverCache:
+    """
+    Content-addressed cover cache on disk: every image URL points to a file named after the SHA-256 of its content,
+    so the same artwork of different shows is only stored once. The least recently used files are removed once the
+    cache is bigger than max_bytes
+    """
+    # only the nugs covers are cached, everything else is passed to Orpheus unchanged
+    ALLOWED_URL = 'https://secure.livedownloads.com/'
+
+    def __init__(self, s: requests.Session, cache, path: str, max_bytes: int = 256 * 1024 * 1024,
+                 timeout: int = 30):
+        self.s = s
+        # the NugsCache holds the url -> hash index
+        self.cache = cache
+        self.path = path
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        os.makedirs(path, exist_ok=True)
+
+        # in-memory url -> file path of this run, also coalesces concurrent fetches of the same cover
+        self.paths = NugsLruCache('covers', max_entries=4096)
+        self.server = None
+        self.server_lock = threading.Lock()
+        # the server only serves the covers registered by local_url, {opaque id: url}
+        self.urls = {}
+
+    def file_path(self, content_hash: str) -> str:
+        return os.path.join(self.path, content_hash)
+
+    def get(self, url: str) -> str:
+        """
+        Returns the path of the cached cover, it's only downloaded if no other thread is already downloading it
+        """
+        path = self.paths.get(url, lambda: self._load(url))
+        # the file got evicted in the meantime
+        if not os.path.exists(path):
+            path = self._load(url)
+            self.paths.put(url, path)
+        return path
+
+    def _load(self, url: str) -> str:
+        content_hash = self.cache.get_cover(url)
+        if content_hash and os.path.exists(self.file_path(content_hash)):
+            metrics.count('cache_hits', cache='covers_disk')
+            return self.file_path(content_hash)
+        metrics.count('cache_misses', cache='covers_disk')
+
+        r = self.s.get(url, timeout=self.timeout)
+        if r.status_code != 200:
+            raise ConnectionError(f'Cover {url} failed with {r.status_code}')
+
+        content_hash = hashlib.sha256(r.content).hexdigest()
+        path = self.file_path(content_hash)
+        if not os.path.exists(path):
+            # write to a temporary file first, so a reader never sees half a cover
+            temp_path = f'{path}.{threading.get_ident()}.part'
+            with open(temp_path, 'wb') as f:
+                f.write(r.content)
+            os.replace(temp_path, path)
+
+        self.cache.set_cover(url, content_hash, len(r.content))
+        for evicted_hash in self.cache.evict_covers(self.max_bytes):
+            if evicted_hash != content_hash and os.path.exists(self.file_path(evicted_hash)):
+                os.remove(self.file_path(evicted_hash))
+        return path
+
+    def local_url(self, url: str) -> str:
+        """
+        Orpheus downloads every cover itself, so the cached covers are served on a loopback-only HTTP server
+        """
+        if not url.startswith(self.ALLOWED_URL):
+            return url
+
+        cover_id = hashlib.sha256(url.encode()).hexdigest()
+        with self.server_lock:
+            if self.server is None:
+                self.server = NugsCoverServer(self)
+                threading.Thread(target=self.server.serve_forever, name='nugs-covers', daemon=True).start()
+            self.urls[cover_id] = url
+        return f'http://127.0.0.1:{self.server.server_address[1]}/{cover_id}'
+
+    def lookup(self, cover_id: str) -> str or None:
+        with self.server_lock:
+            return self.urls.get(cover_id)
+
+
+class NugsCoverHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def _send_empty(self, status: int):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        # anything which wasn't registered by local_url is unknown, so the server can't be used as a proxy
+        url = self.server.covers.lookup(self.path.lstrip('/'))
+        if url is None:
+            self._send_empty(404)
+            return
+
+        try:
+            path = self.server.covers.get(url)
+            with open(path, 'rb') as f:
+                body = f.read()
+        except (requests.RequestException, ConnectionError, OSError):
+            self._send_empty(502)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', mimetypes.guess_type(url)[0] or 'image/jpeg')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class NugsCoverServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, covers: NugsCoverCache):
+        super().__init__(('127.0.0.1', 0), NugsCoverHandler)
+        self.covers = covers
@@ -0,0 +1,94 @@
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import requests
+
+from .nugs_metrics import metrics
+
+
+class NugsSegmentedDownloader:
+    """
+    Downloads a file with several parallel Range requests directly into a preallocated file, the CDN limits the
+    bandwidth per connection
+    """
+    def __init__(self, s: requests.Session, segments: int = 4, min_segment_size: int = 4 * 1024 * 1024,
+                 max_attempts: int = 3, chunk_size: int = 256 * 1024, timeout: int = 30):
+        self.s = s
+        self.segments = segments
+        self.min_segment_size = min_segment_size
+        self.max_attempts = max_attempts
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+
+        self.executor = ThreadPoolExecutor(max_workers=max(segments, 1), thread_name_prefix='nugs-segments')
+
+    def probe(self, url: str, headers: dict = None) -> int or None:
+        """
+        Returns the file size if the server supports Range requests, otherwise None
+        """
+        r = self.s.get(url, headers={**(headers or {}), 'Range': 'bytes=0-0'}, stream=True, timeout=self.timeout)
+        r.close()
+
+        # a 200 means the Range header was ignored, so the file can only be downloaded at once
+        content_range = re.match(r'bytes 0-0/(\d+)', r.headers.get('Content-Range', ''))
+        if r.status_code != 206 or not content_range:
+            return None
+        return int(content_range.group(1))
+
+    def split(self, size: int) -> list:
+        # [(start, end)] with inclusive ends like the Range header, no segment is smaller than min_segment_size
+        segments = max(min(self.segments, size // self.min_segment_size), 1)
+        bounds = [size * i // segments for i in range(segments + 1)]
+        return [(bounds[i], bounds[i + 1] - 1) for i in range(segments)]
+
+    def _download_segment(self, url: str, path: str, headers: dict, start: int, end: int) -> int:
+        # every segment writes at its own position of the file, a failed request resumes where it stopped
+        offset = start
+        for attempt in range(self.max_attempts):
+            if attempt > 0:
+                metrics.count('retries', endpoint='download', method='')
+            try:
+                with self.s.get(url, headers={**headers, 'Range': f'bytes={offset}-{end}'}, stream=True,
+                                timeout=self.timeout) as r:
+                    if r.status_code != 206:
+                        raise ConnectionError(f'Range request failed with {r.status_code}')
+
+                    with open(path, 'r+b') as f:
+                        f.seek(offset)
+                        for chunk in r.iter_content(chunk_size=self.chunk_size):
+                            f.write(chunk)
+                            offset += len(chunk)
+                            metrics.count('bytes', len(chunk), endpoint='download', method='')
+
+                if offset > end:
+                    return offset - start
+            except (requests.RequestException, ConnectionError):
+                if attempt == self.max_attempts - 1:
+                    raise
+
+        raise ConnectionError(f'Segment {start}-{end} is incomplete after {self.max_attempts} attempts')
+
+    def download(self, url: str, path: str, size: int, headers: dict = None):
+        """
+        Downloads the file with the probed size to path, raises a ConnectionError if it's incomplete
+        """
+        headers = headers or {}
+
+        # preallocate the file, so every segment can write at its position
+        with open(path, 'wb') as f:
+            f.truncate(size)
+
+        try:
+            futures = [self.executor.submit(self._download_segment, url, path, headers, start, end)
+                       for start, end in self.split(size)]
+            # wait for all segments, so none of them still writes when the file gets removed
+            wait(futures)
+            written = sum(future.result() for future in futures)
+
+            if written != size or os.path.getsize(path) != size:
+                raise ConnectionError(f'Downloaded {written} of {size} bytes')
+        except Exception:
+            # don't leave an incomplete file in the temp folder
+            os.remove(path)
+            raise
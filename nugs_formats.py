@@ -0,0 +1,142 @@
+import re
+import threading
+from collections import Counter
+
+from utils.models import QualityEnum, CodecOptions
+
+
+class NugsStreamFormats:
+    """
+    Stream format classification and selection table, precomputed once from quality_parse and format_parse
+    """
+    def __init__(self, quality_parse: dict, format_parse: dict, mqa_priority: int = 3, spatial_priority: int = 4):
+        self.format_parse = format_parse
+
+        # a single regex extracts the format key (".flac16/", ".mqa24/", ...) of a stream url
+        self.format_regex = re.compile('|'.join(re.escape(key) for key in format_parse))
+
+        # wanted priorities (highest first) and their bit mask for every quality and codec options combination
+        self.selection = {}
+        for quality_tier, highest_priority in quality_parse.items():
+            for spatial_codecs in (False, True):
+                for proprietary_codecs in (False, True):
+                    # set the highest wanted priority to match Sony 360RA, MQA is only wanted with proprietary_codecs
+                    highest = spatial_priority if spatial_codecs else highest_priority
+                    wanted = tuple(p for p in range(highest, -1, -1) if proprietary_codecs or p != mqa_priority)
+                    self.selection[(quality_tier, spatial_codecs, proprietary_codecs)] = (
+                        wanted, sum(1 << p for p in wanted))
+
+    def classify(self, stream_url: str) -> str or None:
+        # return the format key of the stream and None if it's not a file
+        match = self.format_regex.search(stream_url) if stream_url else None
+        return match.group(0) if match else None
+
+    def wanted(self, quality_tier: QualityEnum, codec_options: CodecOptions) -> tuple:
+        """
+        Returns (wanted priorities with the highest first, priority bit mask)
+        """
+        return self.selection[(quality_tier, bool(codec_options.spatial_codecs),
+                               bool(codec_options.proprietary_codecs))]
+
+    def skippable_platforms(self, mask: int, platform_formats: dict) -> set:
+        """
+        Returns the platformIDs of {platform_id: {format_key, ...}} which only return formats outside of the priority
+        mask, so they can never win. Unknown platformIDs are never skipped
+        """
+        return {platform_id for platform_id, format_keys in platform_formats.items() if format_keys and not any(
+            mask >> self.format_parse[k]['priority'] & 1 for k in format_keys if k in self.format_parse)}
+
+    def probe_order(self, mask: int, platforms: list, predicted: dict = None) -> tuple:
+        """
+        Returns (platformIDs to probe with the most likely winner first, priority which already ends the probing or
+        None) using the predicted {platform_id: format_key} of NugsPlatformStats
+        """
+        predicted = predicted or {}
+        skipped = self.skippable_platforms(
+            mask, {platform_id: {format_key} for platform_id, format_key in predicted.items()})
+
+        def expected_priority(platform_id) -> int:
+            # unknown platformIDs come after all predicted winners
+            format_key = predicted.get(platform_id)
+            return self.format_parse[format_key]['priority'] if format_key in self.format_parse else -1
+
+        # sorted() is stable, so the platformIDs without a prediction keep their order
+        order = sorted([p for p in platforms if p not in skipped], key=expected_priority, reverse=True)
+        if not order:
+            # probe at least one platformID, so the spatial/proprietary warnings still work
+            return list(platforms[:1]), None
+
+        # if every platformID is predicted, nothing better than the best predicted format will be returned
+        target = expected_priority(order[0]) if all(p in predicted for p in platforms) else None
+        return order, target
+
+
+class NugsPlatformStats:
+    """
+    Learns which format every platformID returns per artist and per licensor and era, which is stable in practice
+    """
+    def __init__(self, cache, platforms: list, min_hits: int = 3, confidence: float = 0.9, explore_rate: float = 0.05):
+        self.cache = cache
+        # the cache stores the platformIDs as text
+        self.platforms = {str(p): p for p in platforms}
+        self.min_hits = min_hits
+        self.confidence = confidence
+        # share of the probes which ignore the predictions, so platformIDs which are skipped get observed again
+        self.explore_rate = explore_rate
+
+        self.lock = threading.Lock()
+        # {scope: {platform_id: Counter({format_key: hits})}}
+        self.stats = {}
+
+    @staticmethod
+    def scopes(album) -> list:
+        # most specific scope first, the era is the decade of the release
+        scopes = []
+        if album is None:
+            return scopes
+        if album.artist_id:
+            scopes.append(f'artist:{album.artist_id}')
+        if album.licensor_name:
+            decade = (album.release_date_formatted or '')[:3]
+            scopes.append(f'licensor:{album.licensor_name}:{decade}0s' if decade else f'licensor:{album.licensor_name}')
+        return scopes
+
+    def _load(self, scope: str) -> dict:
+        with self.lock:
+            stats = self.stats.get(scope)
+        if stats is None:
+            stats = {}
+            for platform_id, format_key, hits in self.cache.get_platform_formats(scope):
+                if platform_id in self.platforms:
+                    stats.setdefault(self.platforms[platform_id], Counter())[format_key] = hits
+            with self.lock:
+                stats = self.stats.setdefault(scope, stats)
+        return stats
+
+    def predict(self, scopes: list) -> dict:
+        """
+        Returns {platform_id: format_key} for every platformID which returned the same format often enough, the most
+        specific scope wins
+        """
+        predicted = {}
+        for scope in scopes:
+            stats = self._load(scope)
+            with self.lock:
+                for platform_id, hits in stats.items():
+                    if platform_id in predicted or not hits:
+                        continue
+                    format_key, count = hits.most_common(1)[0]
+                    if sum(hits.values()) >= self.min_hits and count >= self.confidence * sum(hits.values()):
+                        predicted[platform_id] = format_key
+        return predicted
+
+    def record(self, scopes: list, observed: dict):
+        # observed is {platform_id: format_key}, an empty format_key means the platformID didn't return a file
+        if not scopes or not observed:
+            return
+        for scope in scopes:
+            stats = self._load(scope)
+            with self.lock:
+                for platform_id, format_key in observed.items():
+                    stats.setdefault(platform_id, Counter())[format_key] += 1
+        self.cache.add_platform_formats(scopes, observed)
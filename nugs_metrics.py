@@ -0,0 +1,124 @@
+import json
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+
+class NugsMetrics:
+    """
+    Collects per endpoint latencies, bytes, retries, 429s and cache hits/misses, exported with callbacks or as
+    JSON/Prometheus text. Spans group all requests of e.g. a single get_track_info call.
+    """
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+    def __init__(self, max_spans: int = 1000):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = Counter()
+        self.spans = deque(maxlen=max_spans)
+        self.callbacks = []
+
+        # the span of the current thread/context, executors have to run their tasks in a copy of the context
+        self.current_span = ContextVar('nugs_span', default=None)
+
+    def add_callback(self, callback):
+        """
+        callback(event: dict) is called for every request, counter and finished span
+        """
+        self.callbacks.append(callback)
+
+    def _emit(self, event: dict):
+        for callback in self.callbacks:
+            callback(event)
+
+    def count(self, name: str, value: int = 1, **labels):
+        with self.lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += value
+        self._emit({'type': 'counter', 'name': name, 'value': value, 'labels': labels})
+
+    def observe_request(self, endpoint: str, method: str or None, seconds: float, status_code: int or None,
+                        size: int, attempt: int = 0):
+        key = (endpoint, method or '')
+        with self.lock:
+            histogram = self.histograms.setdefault(key, {'buckets': [0] * len(self.BUCKETS), 'sum': 0, 'count': 0})
+            for i, bucket in enumerate(self.BUCKETS):
+                if seconds <= bucket:
+                    histogram['buckets'][i] += 1
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+
+        labels = {'endpoint': endpoint, 'method': method or ''}
+        self.count('bytes', size, **labels)
+        if attempt > 0:
+            self.count('retries', **labels)
+        if status_code == 429:
+            self.count('rate_limited', **labels)
+
+        request = {'type': 'request', 'endpoint': endpoint, 'method': method, 'seconds': seconds,
+                   'status_code': status_code, 'bytes': size, 'attempt': attempt}
+
+        span = self.current_span.get()
+        if span is not None:
+            span['requests'].append(request)
+        self._emit(request)
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        span = {'type': 'span', 'name': name, 'attributes': attributes, 'requests': [], 'start': time.time()}
+        token = self.current_span.set(span)
+        start = time.perf_counter()
+        try:
+            yield span
+        finally:
+            span['seconds'] = time.perf_counter() - start
+            self.current_span.reset(token)
+            with self.lock:
+                self.spans.append(span)
+            self._emit(span)
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {
+                'requests': [{'endpoint': endpoint, 'method': method, 'count': h['count'], 'sum': h['sum'],
+                              'buckets': dict(zip([str(b) for b in self.BUCKETS], h['buckets']))}
+                             for (endpoint, method), h in self.histograms.items()],
+                'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                             for (name, labels), value in self.counters.items()],
+                'spans': list(self.spans),
+            }
+
+    def to_prometheus(self) -> str:
+        def format_labels(labels: dict) -> str:
+            return '{' + ','.join(f'{k}="{v}"' for k, v in labels.items()) + '}' if labels else ''
+
+        lines = ['# TYPE nugs_request_seconds histogram']
+        with self.lock:
+            for (endpoint, method), h in self.histograms.items():
+                labels = {'endpoint': endpoint, 'method': method}
+                for bucket, value in zip(self.BUCKETS, h['buckets']):
+                    le = '+Inf' if bucket == float('inf') else str(bucket)
+                    lines.append(f'nugs_request_seconds_bucket{format_labels({**labels, "le": le})} {value}')
+                lines.append(f'nugs_request_seconds_sum{format_labels(labels)} {h["sum"]}')
+                lines.append(f'nugs_request_seconds_count{format_labels(labels)} {h["count"]}')
+
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f'# TYPE nugs_{name}_total counter')
+                for (counter_name, labels), value in self.counters.items():
+                    if counter_name == name:
+                        lines.append(f'nugs_{name}_total{format_labels(dict(labels))} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path: str):
+        # *.prom files get the Prometheus text format, everything else JSON
+        with open(path, 'w') as f:
+            if path.endswith('.prom'):
+                f.write(self.to_prometheus())
+            else:
+                json.dump(self.to_dict(), f, indent=4)
+
+
+# process-wide metrics, shared by NugsApi, the caches and the interface
+metrics = NugsMetrics()